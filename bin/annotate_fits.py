@@ -4,36 +4,65 @@ to add standard headers to FITS files from the FAI 50cm Maksutov telescope.
 """
 
 import base64
+import bisect
+import calendar
+import contextlib
 import csv
+import datetime
+import hashlib
+import io
+import json
+import multiprocessing
 import os
+import pickle
 import re
+import shutil
+import sqlite3
 import sys
 import tempfile
+import threading
+import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 # Suppress all warnings
 warnings.filterwarnings("ignore")
 from astropy.time import Time
 import astropy.units as u
-from astropy.coordinates import EarthLocation
-from astroquery.simbad import Simbad
-from astroplan.observer import Observer
 from astropy.io import fits
+# astroquery, astroplan, astropy.coordinates, pandas and transliterate
+# are slow to import and only needed on some code paths; they are
+# imported where they are used, so --test, small runs and pool workers
+# start quickly.
 
-from transliterate import translit #for observer
-
-import pandas as pd
 import numpy as np
 
 from gavo.helpers import fitstricks
 from gavo import api
-from gavo.helpers import anet
+
+from plate_io import (ASTROMETRY_OUT_DIR, FITS_BLOCK, block_reduce,
+  open_plate, plate_file_name, read_header_bytes, replacing)
 
 
 ##################################################
 #_______________SOME INITIAL DATA________________#
 ##################################################
 
-observatory= Observer(name='observatory',location=EarthLocation.from_geodetic('76d57m58.00s','43d10m36.00s'))
+# caches that survive between runs live in the resdir (one level above bin)
+CACHE_DIR = os.path.normpath(os.path.join(
+  os.path.dirname(os.path.abspath(__file__)), os.pardir, "cache"))
+
+_observatory = None
+
+def get_observatory():
+  """
+  returns the astroplan Observer for our observatory.
+  """
+  global _observatory
+  if _observatory is None:
+    from astropy.coordinates import EarthLocation
+    from astroplan.observer import Observer
+    _observatory = Observer(name='observatory',location=EarthLocation.from_geodetic('76d57m58.00s','43d10m36.00s'))
+  return _observatory
 
 TELESCOPE_ENG = { #####################MAY BE WE SHOULD USE UPPER CASE TO COMPAIR VALUE WITH DICTIONARY????
   "51cmменисковыйтелескопмаксутова":
@@ -308,6 +337,201 @@ def get_filters_cards(filters):
     return retval
 
 
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~SIMBAD CACHE~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+SIMBAD_CACHE_PATH = os.path.join(CACHE_DIR, "simbad.sqlite")
+SIMBAD_TTL = 365 # days before a known position is asked again
+SIMBAD_NEGATIVE_TTL = 30 # days before an unknown name is asked again
+# Simbad blacklists hosts sending more than about 5 queries per second
+SIMBAD_MAX_RATE = 5
+SIMBAD_WORKERS = 4
+
+def query_simbad(obj):
+  """
+  returns (ra, dec) of obj as "hh:mm:ss" and "dd:mm:ss" strings or None
+  if Simbad does not know obj.
+
+  This is the only place where we go to the network for object names.
+  """
+  from astroquery.simbad import Simbad
+  simbad_table = Simbad.query_object(obj)
+  if simbad_table:#if object data there is in Simbad
+    return (":".join(simbad_table["RA"].data[0].split(" ")),
+      ":".join(simbad_table["DEC"].data[0].split(" ")))
+  return None
+
+
+class SimbadCache:
+  """
+  a persistent (sqlite) cache of Simbad positions by object name.
+
+  Names Simbad does not know are cached, too (with a shorter ttl), so
+  we don't ask for the same comet designation on every plate.  Stale
+  entries are re-queried unless offline is set; in offline mode, we
+  never go to the network and names not in the cache resolve to None.
+
+  ttl and negative_ttl are in days.
+
+  >>> cache = SimbadCache(":memory:", offline=True)
+  >>> cache.put("M44", "08:40:22.2", "+19:40:19")
+  >>> cache.resolve("M44")
+  ('08:40:22.2', '+19:40:19')
+  >>> cache.resolve("NGC6611") is None
+  True
+  >>> cache = SimbadCache(":memory:")
+  >>> cache.resolve("M44", resolver=lambda obj: None) is None
+  True
+  >>> cache.resolve("M44", resolver=lambda obj: ("00:00:00", "+00:00:00")) is None
+  True
+  """
+  def __init__(self, path, ttl=SIMBAD_TTL, negative_ttl=SIMBAD_NEGATIVE_TTL,
+      offline=False):
+    self.ttl, self.negative_ttl = ttl*86400, negative_ttl*86400
+    self.offline = offline
+    self.path = path
+    if path!=":memory:":
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+    self.reconnect()
+
+  def reconnect(self):
+    """
+    opens a fresh connection to the cache file.
+
+    Call this in forked children; sqlite connections must not be used
+    across a fork.
+    """
+    # generous timeout as several processes may share the file
+    self.conn = sqlite3.connect(self.path, timeout=60)
+    self.conn.execute("CREATE TABLE IF NOT EXISTS simbad ("
+      " name TEXT PRIMARY KEY, ra TEXT, dec TEXT, fetched REAL)")
+    self.conn.commit()
+
+  def get(self, obj):
+    """
+    returns a pair (known, position) for obj.
+
+    known is False if obj is not in the cache or its entry is stale;
+    position is None for names Simbad could not resolve.
+    """
+    row = self.conn.execute("SELECT ra, dec, fetched FROM simbad"
+      " WHERE name=?", (obj,)).fetchone()
+    if row is None:
+      return False, None
+    ra, dec, fetched = row
+    ttl = self.ttl if ra is not None else self.negative_ttl
+    if not self.offline and time.time()-fetched>ttl:
+      return False, None
+    if ra is None:
+      return True, None
+    return True, (ra, dec)
+
+  def put(self, obj, ra, dec):
+    """
+    remembers the position of obj (pass None, None for unknown names).
+    """
+    self.conn.execute("INSERT OR REPLACE INTO simbad (name, ra, dec, fetched)"
+      " VALUES (?, ?, ?, ?)", (obj, ra, dec, time.time()))
+    self.conn.commit()
+
+  def resolve(self, obj, resolver=query_simbad):
+    """
+    returns (ra, dec) for obj or None, asking resolver only if we
+    have no fresh answer and are not offline.
+    """
+    known, position = self.get(obj)
+    if known or self.offline:
+      return position
+    position = resolver(obj)
+    self._store(obj, position)
+    return position
+
+  def _store(self, obj, position):
+    if position is None:
+      self.put(obj, None, None)
+    else:
+      self.put(obj, *position)
+
+  def prefetch(self, names, resolver=query_simbad, workers=SIMBAD_WORKERS,
+      max_rate=SIMBAD_MAX_RATE):
+    """
+    resolves all names not yet (freshly) in the cache, running up to
+    workers resolver calls concurrently, but starting no more than
+    max_rate of them per second.
+
+    Names the resolver fails on (timeouts, HTTP errors) are reported and
+    not cached; resolve will try them again.  This returns the number of
+    names actually sent to resolver.
+
+    >>> def resolver(obj):
+    ...   if obj=="Comet Halley":
+    ...     raise TimeoutError("Simbad did not answer")
+    ...   return ("08:40:22.2", "+19:40:19") if obj=="M44" else None
+    >>> cache = SimbadCache(":memory:")
+    >>> cache.prefetch(["M44", "NGC6611", "M44", "Comet Halley"],
+    ...   resolver=resolver)
+    Cannot resolve Comet Halley: TimeoutError: Simbad did not answer
+    3
+    >>> cache.prefetch(["M44", "NGC6611"], resolver=None)
+    0
+    >>> cache.get("M44"), cache.get("NGC6611"), cache.get("Comet Halley")
+    ((True, ('08:40:22.2', '+19:40:19')), (True, None), (False, None))
+    """
+    if self.offline:
+      return 0
+    missing = sorted(set(obj for obj in names if not self.get(obj)[0]))
+    if not missing:
+      return 0
+
+    lock, next_start = threading.Lock(), [time.monotonic()]
+    def resolve_one(obj):
+      with lock:
+        now = time.monotonic()
+        start = max(now, next_start[0])
+        next_start[0] = start+1/max_rate
+      time.sleep(start-now)
+      try:
+        return resolver(obj), None
+      except Exception as ex:
+        return None, f"{ex.__class__.__name__}: {ex}"
+
+    # the resolver calls run in threads, but sqlite connections must stay
+    # in the thread that made them, so we store from here.
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+      for obj, (position, error) in zip(missing, pool.map(resolve_one, missing)):
+        if error:
+          print(f"Cannot resolve {obj}: {error}")
+        else:
+          self._store(obj, position)
+    return len(missing)
+
+
+def iter_object_names(platemeta):
+  """
+  iterates over the names in the OBJECT fields of the logbook records
+  in platemeta, split the way _mungeHeader splits them.
+
+  Records with both RA and DEC are skipped; _getPointing never asks
+  Simbad about them.
+
+  >>> sorted(set(iter_object_names({
+  ...   "a": {"OBJECT": "NGC6611;NGC6618", "RA": " ", "DEC": " "},
+  ...   "b": {"OBJECT": "M44", "RA": "", "DEC": ""},
+  ...   "c": {"OBJECT": " ", "RA": " ", "DEC": " "},
+  ...   "d": {"OBJECT": "M44,M45", "RA": "8h40m", "DEC": " "},
+  ...   "e": {"OBJECT": "M31", "RA": "0h42m", "DEC": "41 16"}})))
+  ['M44', 'M45', 'NGC6611', 'NGC6618']
+  """
+  for rec in platemeta.values():
+    rec = blank_to_none(rec)
+    obj_name = rec["OBJECT"]
+    if rec["RA"] and rec["DEC"]:
+      continue
+    if obj_name and obj_name.strip():
+      yield from obj_name.replace(",",";").split(";")
+
+
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 #~~~~~~~~~~~~~~~~~~COORDINATES~~~~~~~~~~~~~~~~~~~~
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -472,6 +696,122 @@ def reformat_ra(raw_ra):
     raw_ra = raw_ra.split(";")
     return [reformat_single_ra(ra) for ra in raw_ra]
 
+# The column parsers below do what ra_to_deg and dec_to_deg do, but on
+# whole logbook columns at a time.  The patterns are RA_FORMATS and
+# DEC_FORMATS combined into one regex each (alternatives are tried in
+# order, as in the loops above; the colon formats are left out because
+# colons are turned into blanks first).
+RA_COLUMN_PATTERN = (r"^(?:"
+  r"(?P<h1>\d+) (?P<m1>\d+)(?: (?P<s1>\d+(?:.\d+)?))?$"
+  r"|(?P<h2>\d+)h(?P<m2>\d+(?:\.\d+)?)m(?:(?P<s2>\d+)s)?$"
+  r"|(?P<h3>\d+)h(?P<m3>\d+(?:m?\.\d+)?)(?:(?P<s3>\d+)s)?$)")
+
+DEC_COLUMN_PATTERN = (r"^(?P<sign>-?)(?:"
+  r"(?P<d1>\d+\.?\d*)$"
+  r"|(?P<d2>\d+) (?P<m2>\d+\.?\d*)$"
+  r"|(?P<d3>\d+) (?P<m3>\d+)(?: (?P<s3>\d+(?:.\d+)?))?$)")
+
+def _extracted_number(parts, names, default=None):
+  """
+  returns a float series of the first non-null of the columns names in
+  the str.extract result parts (nan if none matched or it's not a number).
+  """
+  col = parts[names[0]]
+  for name in names[1:]:
+    col = col.fillna(parts[name])
+  if default is not None:
+    col = col.fillna(default)
+  import pandas as pd
+  return pd.to_numeric(col.str.replace("m", "", regex=False), errors="coerce")
+
+def _prepare_column(raw_values, drop=""):
+  """
+  returns raw_values as a pandas series of stripped strings with colons
+  turned into blanks and the characters in drop removed, and a boolean
+  series that is true where there is a value at all.
+  """
+  import pandas as pd
+  col = pd.Series(list(raw_values), dtype=object).str.strip()
+  for char in drop:
+    col = col.str.replace(char, "", regex=False)
+  col = col.str.replace(":", " ", regex=False)
+  return col, (col.notna() & (col!="")).to_numpy()
+
+def ra_column_to_deg(raw_ras):
+  """
+  returns a float array of the right ascensions in raw_ras in degrees
+  and a boolean array that is True where there was a value that could
+  not be parsed.
+
+  Missing values come back as nan without being flagged.
+
+  >>> deg, bad = ra_column_to_deg(
+  ...   ["05 32 49", "05h33m", None, "12h", "02h41m45s", "01:28", ""])
+  >>> ["{:.5f}".format(d) for d in deg]
+  ['83.20417', '83.25000', 'nan', 'nan', '40.43750', '22.00000', 'nan']
+  >>> bad.tolist()
+  [False, False, False, True, False, False, False]
+  """
+  col, present = _prepare_column(raw_ras)
+  parts = col.str.extract(RA_COLUMN_PATTERN)
+  hours = (_extracted_number(parts, ["h1", "h2", "h3"])
+    + _extracted_number(parts, ["m1", "m2", "m3"])/60.
+    + _extracted_number(parts, ["s1", "s2", "s3"], "0")/3600.)
+  deg = (hours/24*360).to_numpy(dtype=float)
+  return deg, present & np.isnan(deg)
+
+def dec_column_to_deg(raw_decs):
+  """
+  returns a float array of the declinations in raw_decs in degrees
+  and a boolean array that is True where there was a value that could
+  not be parsed.
+
+  >>> deg, bad = dec_column_to_deg(
+  ...   ["29.06", "-23.30", "50 41 45", "+01:28:02", "-01 28", "x", None])
+  >>> ["{:.5f}".format(d) for d in deg]
+  ['29.06000', '-23.30000', '50.69583', '1.46722', '-1.46667', 'nan', 'nan']
+  >>> bad.tolist()
+  [False, False, False, False, False, True, False]
+  """
+  col, present = _prepare_column(raw_decs, drop="+")
+  parts = col.str.extract(DEC_COLUMN_PATTERN)
+  deg = (_extracted_number(parts, ["d1", "d2", "d3"])
+    + _extracted_number(parts, ["m2", "m3"], "0")/60.
+    + _extracted_number(parts, ["s3"], "0")/3600.)
+  deg = deg.where(parts["sign"]!="-", -deg).to_numpy(dtype=float)
+  return deg, present & np.isnan(deg)
+
+def coordinate_lists_to_deg(raw_lists, column_parser, what):
+  """
+  returns a list of (degrees, error) pairs for a sequence of ;-separated
+  raw coordinate lists.
+
+  degrees is a list of floats (or None for missing lists), error is None
+  or a message naming the first item column_parser could not handle.
+  what is "RA" or "Dec" for these messages.
+
+  >>> coordinate_lists_to_deg(["05 32 49;05h33m", None, "02h41m45s;12h"],
+  ...   ra_column_to_deg, "RA")
+  [([83.20416666666667, 83.25], None), (None, None), (None, 'ValueError: Not a valid RA 12h')]
+  """
+  import pandas as pd
+  items = pd.Series(list(raw_lists), dtype=object).str.split(";").explode()
+  deg, _ = column_parser(items.to_numpy())
+
+  result = [(None, None) for _ in range(len(raw_lists))]
+  for row, value, raw in zip(items.index, deg, items.to_numpy()):
+    if not isinstance(raw, str):
+      continue
+    degs, error = result[row]
+    if error:
+      continue
+    if np.isnan(value):
+      result[row] = (None,
+        f"ValueError: Not a valid {what} {raw.strip().replace(':', ' ')}")
+    else:
+      result[row] = ((degs or [])+[float(value)], None)
+  return result
+
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 #~~~~~~~~~~~~~~~~~~~EXPOSURE~~~~~~~~~~~~~~~~~~~~~~
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -640,8 +980,13 @@ def get_time_start_cards(raw_times, time_format):
   {'TMS-ORIG': 'LT 01:23:12'}
   >>> get_time_start_cards("13h23m;5h13;12h15m54s", "LST ")
   {'TMS-ORIG': 'LST 13:23:00', 'TMS-OR1': 'LST 13:23:00', 'TMS-OR2': 'LST 05:13:00', 'TMS-OR3': 'LST 12:15:54'}
+  >>> get_time_start_cards(["13:23:00"], "LT ")
+  {'TMS-ORIG': 'LT 13:23:00'}
   """
-  times = reformat_time(raw_times)
+  if isinstance(raw_times, list): #already went through reformat_time
+    times = raw_times
+  else:
+    times = reformat_time(raw_times)
   if len(times)==1:
     return {"TMS-ORIG": f"{time_format}{times[0]}"}
   else:
@@ -660,7 +1005,10 @@ def get_time_end_cards(raw_times, time_format):
   >>> get_time_end_cards("13h23m;5h13;12h15m54s", "LST ")
   {'TME-ORIG': 'LST 13:23:00', 'TME-OR1': 'LST 13:23:00', 'TME-OR2': 'LST 05:13:00', 'TME-OR3': 'LST 12:15:54'}
   """
-  times = reformat_time(raw_times)
+  if isinstance(raw_times, list): #already went through reformat_time
+    times = raw_times
+  else:
+    times = reformat_time(raw_times)
   if len(times)==1:
     return {"TME-ORIG": f"{time_format}{times[0]}"}
   else:
@@ -972,19 +1320,96 @@ def get_object_altitude(dec,phi,hour_angle):
   """
   return 90 - np.arccos(np.sin(phi*u.degree)*np.sin(dec*u.degree)+np.cos(phi*u.degree)*np.cos(dec*u.degree)*np.cos(hour_angle*u.degree)).to_value("degree")
 
+SUN_TABLE_PATH = os.path.join(CACHE_DIR, "sun-set-rise.npz")
+SUN_TABLE_START = datetime.date(1950, 1, 1)
+SUN_TABLE_END = datetime.date(2001, 1, 2) # exclusive; we look up the day after the first obs date
+
+_sun_table = None
+
+def build_sun_table(observatory, path=SUN_TABLE_PATH,
+    start=SUN_TABLE_START, end=SUN_TABLE_END):
+  """
+  computes sunset and sunrise for observatory for each civil date
+  from start to end (exclusive) and saves them to path.
+
+  Each row has jd1, jd2 of the sunset and jd1, jd2 of the sunrise
+  as solve_sun_set_rise_time returns them; rows for dates the solver
+  fails on are nan.  This takes a while; see --build-sun-table.
+  """
+  n_days = (end-start).days
+  table = np.full((n_days, 4), np.nan)
+  for index in range(n_days):
+    day = start+datetime.timedelta(days=index)
+    try:
+      sunset, sunrise = solve_sun_set_rise_time(
+        Time(f"{day.isoformat()} 00:00:00"), observatory)
+    except ValueError:
+      continue
+    table[index] = [np.ravel(sunset.jd1)[0], np.ravel(sunset.jd2)[0],
+      np.ravel(sunrise.jd1)[0], np.ravel(sunrise.jd2)[0]]
+
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  np.savez(path, table=table, start=start.toordinal(),
+    site=[observatory.location.lon.deg, observatory.location.lat.deg])
+
+def get_sun_table(path=SUN_TABLE_PATH):
+  """
+  returns the table written by build_sun_table as a dict with keys
+  table, start (a proleptic ordinal) and site (lon, lat), or None if
+  there is no table.
+
+  The table is only read once.
+  """
+  global _sun_table
+  if _sun_table is None:
+    try:
+      with np.load(path) as arrs:
+        _sun_table = dict((key, arrs[key]) for key in arrs.files)
+    except OSError:
+      _sun_table = {}
+  return _sun_table or None
+
 def sun_set_rise_time(date,observatory):
   """
   Returns sunset and sunrise time for observational point
+
+  This looks up the table made by build_sun_table if it is there and
+  was made for observatory's location; otherwise (or if the table
+  does not cover date), it uses solve_sun_set_rise_time.  Only the
+  civil date of date is used.
+
+  date -- time function
+  observatory -- astroplan object with neccessary data about observatation place
+  """
+  sun_table = get_sun_table()
+  if (sun_table
+      and np.allclose(sun_table["site"],
+        [observatory.location.lon.deg, observatory.location.lat.deg])):
+    index = (datetime.date.fromisoformat(date.iso[:10]).toordinal()
+      -int(sun_table["start"]))
+    if 0<=index<len(sun_table["table"]):
+      row = sun_table["table"][index]
+      if not np.isnan(row[0]):
+        return (Time(row[0], row[1], format="jd"),
+          Time(row[2], row[3], format="jd"))
+  return solve_sun_set_rise_time(date, observatory)
+
+def solve_sun_set_rise_time(date,observatory):
+  """
+  Returns sunset and sunrise time for observational point
   Sometimes function define wrong date of sunset/sunrise
   because parameters ("next","near","previous") are not
   universal.
 
+  This runs astroplan's solvers; use sun_set_rise_time, which
+  tries the precomputed table first.
+
   date -- time function
   observatory -- astroplan object with neccessary data about observatation place
 
-  >>> sun_set_rise_time(Time("1987-08-12 00:00:00"),observatory= Observer(name='observatory',location=EarthLocation.from_geodetic('76d57m58.00s','43d10m36.00s')))
+  >>> solve_sun_set_rise_time(Time("1987-08-12 00:00:00"),observatory=get_observatory())
   (<Time object: scale='utc' format='jd' value=2447019.3312281347>, <Time object: scale='utc' format='jd' value=2447019.748774269>)
-  >>> sun_set_rise_time(Time("1964-01-23 00:00:00"),observatory= Observer(name='observatory',location=EarthLocation.from_geodetic('76d57m58.00s','43d10m36.00s')))
+  >>> solve_sun_set_rise_time(Time("1964-01-23 00:00:00"),observatory=get_observatory())
   (<Time object: scale='utc' format='jd' value=2438417.2391776997>, <Time object: scale='utc' format='jd' value=2438417.8487855475>)
   """
 
@@ -1021,286 +1446,86 @@ def sun_set_rise_time(date,observatory):
 #~~~~~~~~~~~~~~~~~DATE-TIME UT~~~~~~~~~~~~~~~~~~~~
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+def _last_sunday(year, month):
+  """
+  returns the day of month of the last Sunday in month of year.
+
+  >>> _last_sunday(1984, 3), _last_sunday(1985, 3), _last_sunday(1996, 10)
+  (25, 31, 27)
+  """
+  last_day = calendar.monthrange(year, month)[1]
+  return last_day-(datetime.date(year, month, last_day).weekday()+1)%7
+
+def _build_utc_offset_table():
+  """
+  returns a list of local datetimes and a list of UTC offsets (hours)
+  for Almaty; each offset applies from its datetime until the next one.
+
+  This is Soviet decree time (UTC+6) with summer time from 1981 on,
+  switching at 3 a.m. local time on the last Sunday of March and of
+  September (October from 1996 on).  Decree time was abolished for 1991
+  and restored on January 19, 1992; there is no summer time from 2005
+  on.
+  """
+  transitions = [(datetime.datetime(1900, 1, 1), 6)]
+  for year in range(1981, 2005):
+    standard = 5 if year==1991 else 6
+    if year==1992: # decree time restored
+      transitions.append((datetime.datetime(year, 1, 1), 5))
+      transitions.append((datetime.datetime(year, 1, 19), 6))
+    else:
+      transitions.append((datetime.datetime(year, 1, 1), standard))
+    transitions.append((datetime.datetime(
+      year, 3, _last_sunday(year, 3), 3), standard+1))
+    autumn_month = 10 if year>=1996 else 9
+    transitions.append((datetime.datetime(
+      year, autumn_month, _last_sunday(year, autumn_month), 3), standard))
+  transitions.append((datetime.datetime(2005, 1, 1), 6))
+  return [t for t, _ in transitions], [float(h) for _, h in transitions]
+
+UTC_OFFSET_STARTS, UTC_OFFSET_HOURS = _build_utc_offset_table()
+UTC_OFFSET_STARTS_NP = np.array(UTC_OFFSET_STARTS, dtype="datetime64[us]")
+UTC_OFFSET_HOURS_NP = np.array(UTC_OFFSET_HOURS)
+
 def get_delta_real(date):
 
   """
   Returns true delta (float, hours)
-  date - time function of date of observ
+  date - time function of date of observ (local time)
+
+  This looks up the UTC offset table (see _build_utc_offset_table).
 
   >>> get_delta_real(Time("1964-08-13 00:00:00.000"))
   <Quantity 6. h>
   >>> get_delta_real(Time("1984-03-25 03:45:54.000"))
   <Quantity 7. h>
-
+  >>> get_delta_real(Time("1984-03-25 02:45:54.000"))
+  <Quantity 6. h>
+  >>> get_delta_real(Time("1985-03-31 12:00:00.000"))
+  <Quantity 7. h>
+  >>> get_delta_real(Time("1991-12-31 12:00:00.000"))
+  <Quantity 5. h>
+  >>> get_delta_real(Time("1992-01-19 12:00:00.000"))
+  <Quantity 6. h>
+  >>> get_delta_real(Time("1998-01-15 12:00:00.000"))
+  <Quantity 6. h>
+  >>> get_delta_real(Time("1998-10-20 12:00:00.000"))
+  <Quantity 7. h>
   """
-  sunday = Time("2022-05-01 00:00:00")
-  y = date.datetime.year#year of observation
-  m = date.datetime.month#month of observation
-  d = date.datetime.day#day of observation
-  hour = date.datetime.hour#day of observation
-
-  if y >= 1981 and y < 1991:
-      if m == 3:
-          if d >=25 and d <= 31:
-              modulo = (date - sunday).value%7
-              if modulo < 1:
-                  if int(hour) >= 3:
-                      delta=7*u.hour
-                  else:
-                      delta= 6*u.hour
-              else:
-                  t = Time(f"{y}-{m}-23 00:00:00")
-                  modulo = 2
-                  while modulo >= 1:
-                      t = t + 1*u.day
-                      modulo = (t - sunday).value % 7
-                      continue
-                  else:
-                      if date < t:
-                          delta = 6*u.hour
-                      else:
-                          delta = 7*u.hour
-
-          else:
-              delta = 6*u.hour
-
-      elif m == 9:
-          if d >=24 and d <= 30:
-              modulo = (date - sunday).value%7
-              if modulo < 1:
-                  if int(hour) >= 3:
-                      delta = 6*u.hour
-                  else:
-                      delta = 7*u.hour
-              else:
-                  t = Time(f"{y}-{m}-23 00:00:00")
-                  modulo = 2
-                  while modulo >= 1:
-                      t = t + 1*u.day
-                      modulo = (t - sunday).value % 7
-                      continue
-                  else:
-                      if date < t:
-                          delta = 7*u.hour
-                      else:
-                          delta = 6*u.hour
-          else:
-              delta = 7*u.hour
-
-      elif m > 3 and m < 9:
-          delta = 7*u.hour
-      else:
-          delta = 6*u.hour
-
-  elif y == 1991:
-      if m == 3:
-          if d >=25 and d <= 31:
-              modulo = (date - sunday).value%7
-              if modulo < 1:
-                  if int(hour) >= 3:
-                      delta = 6*u.hour
-                  else:
-                      delta = 5*u.hour
-              else:
-                  t = Time(f"{y}-{m}-23 00:00:00")
-                  modulo = 2
-                  while modulo >= 1:
-                      t = t + 1*u.day
-                      modulo = (t - sunday).value % 7
-                  else:
-                      if date < t:
-                          delta = 5*u.hour
-                      else:
-                          delta = 6*u.hour
-          else:
-              delta = 5*u.hour
-
-      elif m == 9:
-          if d >=24 and d <= 30:
-              modulo = (date - sunday).value%7
-              if modulo < 1:
-                  if int(hour) >= 3:
-                      delta = 5*u.hour
-                  else:
-                      delta = 6*u.hour
-              else:
-                  t = Time(f"{y}-{m}-23 00:00:00")
-                  modulo = 2
-                  while modulo >= 1:
-                      t = t + 1*u.day
-                      modulo = (t - sunday).value % 7
-                  else:
-                      if date < t:
-                          delta = 6*u.hour
-                      else:
-                          delta = 5*u.hour
-          else:
-              delta = 6*u.hour
-
-      elif m > 3 and m < 9:
-          delta = 6*u.hour
-      else:
-          delta = 5*u.hour
+  index = bisect.bisect_right(UTC_OFFSET_STARTS, date.datetime)-1
+  return UTC_OFFSET_HOURS[index]*u.hour
 
-  elif y == 1992:
-      if m == 1:
-          if d <19:
-              delta = 5*u.hour
-          else:
-              delta = 6*u.hour
-
-      elif m == 3:
-          if d >=25 and d <= 31:
-              modulo = (date - sunday).value%7
-              if modulo < 1:
-                  if int(hour) >= 3:
-                      delta = 7*u.hour
-                  else:
-                      delta = 6*u.hour
-              else:
-                  t = Time(f"{y}-{m}-23 00:00:00")
-                  modulo = 2
-                  while modulo >= 1:
-                      t = t + 1*u.day
-                      modulo = (t - sunday).value % 7
-                  else:
-                      if date < t:
-                          delta = 6*u.hour
-                      else:
-                          delta = 7*u.hour
-          else:
-              delta = 6*u.hour
-
-      elif m == 9:
-          if d >=24 and d <= 30:
-              modulo = (date - sunday).value%7
-              if modulo < 1:
-                  if int(hour) >= 3:
-                      delta = 6*u.hour
-                  else:
-                      delta = 7*u.hour
-              else:
-                  t = Time(f"{y}-{m}-23 00:00:00")
-                  modulo = 2
-                  while modulo >= 1:
-                      t = t + 1*u.day
-                      modulo = (t - sunday).value % 7
-                  else:
-                      if date < t:
-                          delta = 7*u.hour
-                      else:
-                          delta = 6*u.hour
-          else:
-              delta = 7*u.hour
-
-      elif m > 3 and m < 9 and m!=1:
-          delta = 7*u.hour
-      else: #2,10,11,12
-          delta = 6*u.hour
-
-  elif y >= 1993 and y < 1996:
-      if m == 3:
-          if d >=25 and d <= 31:
-              modulo = (date - sunday).value%7
-              if modulo < 1:
-                  if int(hour) >= 3:
-                      delta = 7*u.hour
-                  else:
-                      delta = 6*u.hour
-              else:
-                  t = Time(f"{y}-{m}-23 00:00:00")
-                  modulo = 2
-                  while modulo >= 1:
-                      t = t + 1*u.day
-                      modulo = (t - sunday).value % 7
-                  else:
-                      if date < t:
-                          delta = 6*u.hour
-                      else:
-                          delta = 7*u.hour
-          else:
-              delta = 6*u.hour
-
-      elif m == 9:
-          if d >=24 and d <= 30:
-              modulo = (date - sunday).value%7
-              if modulo < 1:
-                  if int(hour) >= 3:
-                      delta = 6*u.hour
-                  else:
-                      delta = 7*u.hour
-              else:
-                  t = Time(f"{y}-{m}-23 00:00:00")
-                  modulo = 2
-                  while modulo >= 1:
-                      t = t + 1*u.day
-                      modulo = (t - sunday).value % 7
-                  else:
-                      if date < t:
-                          delta = 7*u.hour
-                      else:
-                          delta = 6*u.hour
-          else:
-              delta = 7*u.hour
-
-      elif m > 3 and m < 9:
-          delta = 7*u.hour
-      else:
-          delta = 6*u.hour
-
-  elif y >= 1996 and y < 2005:
-      if m == 3:
-          if d >=25 and d <= 31:
-              modulo = (date - sunday).value%7
-              if modulo < 1:
-                  if int(hour) >= 3:
-                      delta = 7*u.hour
-                  else:
-                      delta = 6*u.hour
-              else:
-                  t = Time(f"{y}-{m}-23 00:00:00")
-                  modulo = 2
-                  while modulo >= 1:
-                      t = t + 1*u.day
-                      modulo = (t - sunday).value % 7
-                  else:
-                      if date < t:
-                          delta = 6 *u.hour
-                      else:
-                          delta = 7*u.hour
-          else:
-              delta = 6*u.hour
-
-      elif m == 10:
-          if d >=25 and d <= 31:
-              modulo = (date - sunday).value%7
-              if modulo < 1:
-                  if int(hour) >= 3:
-                      delta = 6*u.hour
-                  else:
-                      delta = 7*u.hour
-              else:
-                  t = Time(f"{y}-{m}-23 00:00:00")
-                  modulo = 2
-                  while modulo >= 1:
-                      t = t + 1*u.day
-                      modulo = (t - sunday).value % 7
-                  else:
-                      if date < t:
-                          delta = 7*u.hour
-                      else:
-                          delta = 6*u.hour
-          else:
-              delta = 7*u.hour
-
-      elif m > 3 and m < 10:
-          delta = 7*u.hour
-      else:
-          delta = 7*u.hour
-  elif y <=1980 or y >= 2005:
-      delta = 6*u.hour
+def get_utc_offsets(dates):
+  """
+  returns an array of UTC offsets in hours for a Time array of local
+  date-times; this is the vectorized get_delta_real.
 
-  return delta
+  >>> get_utc_offsets(Time(["1964-08-13 00:00:00", "1984-03-25 03:45:54"]))
+  array([6., 7.])
+  """
+  indices = np.searchsorted(UTC_OFFSET_STARTS_NP,
+    dates.datetime64.astype("datetime64[us]"), side="right")-1
+  return UTC_OFFSET_HOURS_NP[indices]
 
 def convert_local_date_time_UT(dates, obs_times):
   """
@@ -1432,10 +1657,632 @@ def degToDms(deg):
 
   return f"{sign}{d}:{m}:{s}"
 
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~TIME FORMAT (BATCH)~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _sun_set_rise_arrays(days, observatory):
+  """
+  returns Time arrays of sunsets and sunrises (as sun_set_rise_time
+  has them) for a sequence of datetime.date days, together with a
+  boolean array that is False where they could not be determined.
+
+  Days not in the sun table are solved for with astroplan, each
+  distinct day once.
+  """
+  ordinals, inverse = np.unique(
+    np.array([day.toordinal() for day in days], dtype=int),
+    return_inverse=True)
+  jds = np.full((len(ordinals), 4), np.nan)
+  sun_table = get_sun_table()
+  if (sun_table
+      and np.allclose(sun_table["site"],
+        [observatory.location.lon.deg, observatory.location.lat.deg])):
+    table = sun_table["table"]
+    indices = ordinals-int(sun_table["start"])
+    in_table = (indices>=0) & (indices<len(table))
+    jds[in_table] = table[indices[in_table]]
+
+  to_solve = np.flatnonzero(np.isnan(jds[:,0]))
+  if len(to_solve) and not sun_table:
+    print(f"No sunset/sunrise table in {SUN_TABLE_PATH}; solving for"
+      f" {len(to_solve)} nights (run with --build-sun-table to save"
+      " this time)")
+  for index in to_solve:
+    day = datetime.date.fromordinal(int(ordinals[index]))
+    try:
+      sunset, sunrise = solve_sun_set_rise_time(
+        Time(f"{day.isoformat()} 00:00:00"), observatory)
+    except ValueError:
+      continue
+    jds[index] = [np.ravel(sunset.jd1)[0], np.ravel(sunset.jd2)[0],
+      np.ravel(sunrise.jd1)[0], np.ravel(sunrise.jd2)[0]]
+
+  jds = jds[inverse]
+  sun_ok = ~np.isnan(jds[:,0])
+  jds[~sun_ok] = 0
+  return (Time(jds[:,0], jds[:,1], format="jd"),
+    Time(jds[:,2], jds[:,3], format="jd"),
+    sun_ok)
+
+def _check_time_row(date, obs_time, ra, dec):
+  """
+  returns the date as yyyy-mm-dd and obs_time with hour 24 made 0 for
+  a row of infer_time_formats, or raises a ValueError if the row would
+  break the array computations there.
+
+  >>> _check_time_row("14.09.1964", "24:05:30", None, None)
+  ('1964-09-14', '00:05:30')
+  >>> _check_time_row("31.09.1964", "01:24:06", None, None)
+  Traceback (most recent call last):
+  ValueError: day is out of range for month
+  """
+  d = date.replace(" ","").split(".")
+  ymd = f"{d[-1]}-{d[1]}-{d[0]}"
+  datetime.date.fromisoformat(ymd)
+  api.dmsToDeg(obs_time, ":")
+  #%24 because somewhere we have time like 24:05:30
+  if obs_time.split(":")[0]=="24":
+    obs_time = "00:"+":".join(obs_time.split(":")[1:])
+  Time(f"{ymd} {obs_time}")
+  if ra is not None and dec is not None:
+    api.dmsToDeg(ra, ":")
+    api.dmsToDeg(dec, ":")
+  return ymd, obs_time
+
+def infer_time_formats(dates, obs_times, ras, decs, observatory):
+  """
+  decides for whole arrays of plates whether the logged times are local
+  time or local sidereal time, and computes the UT DATE-OBS from them.
+
+  This is what _mungeHeader does plate by plate when it has a date and a
+  time, with the astropy computations done on Time arrays.
+
+  dates -- first dates of observation (dd.mm.yyyy, see parse_date_list)
+  obs_times -- first logged times (hh:mm:ss, see reformat_time)
+  ras, decs -- first RA and Dec (hh:mm:ss, dd:mm:ss) or None
+  observatory -- astroplan object with neccessary data about observatation place
+
+  This returns two lists, the time_format prefixes ("LT ", "LST ", or
+  "Neither LT nor ST") and the DATE-OBS values in FITS format (None if
+  it cannot be computed).  Where the sun could not be computed or the
+  row is malformed (see _check_time_row), both are None, so the caller
+  can fall back to the plate-by-plate code.
+
+  >>> with contextlib.redirect_stdout(io.StringIO()): # no sun table hint
+  ...   formats, dates_obs = infer_time_formats(
+  ...     ["14.09.1964", "09.02.1989", "14.09.1964", "30.x1.1929",
+  ...       "31.09.1964"],
+  ...     ["01:24:06", "10:24:06", "01:24:06", "01:00:00", "01:00:00"],
+  ...     [None, None, "00:00:00", None, None],
+  ...     [None, None, "-80:00:00", None, None], get_observatory())
+  >>> formats
+  ['LT ', 'LST ', 'Neither LT nor ST', None, None]
+  >>> lt = convert_local_date_time_UT(["14.09.1964"], ["01:24:06"])[0]
+  >>> st_local = get_lt_from_st(["09.02.1989"], ["10:24:06"])[0]
+  >>> st = (st_local-get_delta_real(st_local)).fits
+  >>> [bool(abs((Time(a)-Time(b)).sec)<0.01)
+  ...   for a, b in zip(dates_obs, [lt, st])]
+  [True, True]
+  >>> dates_obs[2:]
+  [None, None, None]
+  """
+  n_rows = len(dates)
+  rows = []
+  for index, row in enumerate(zip(dates, obs_times, ras, decs)):
+    try:
+      rows.append((index,)+_check_time_row(*row)+row[1:])
+    except LOGBOOK_ERRORS:
+      pass
+  time_formats, dates_obs = [None]*n_rows, [None]*n_rows
+  if not rows:
+    return time_formats, dates_obs
+
+  indices, ymds, fixed_times, obs_hours, ra_hours, dec_degs = (
+    [], [], [], [], [], [])
+  for index, ymd, fixed_time, obs_time, ra, dec in rows:
+    indices.append(index)
+    ymds.append(ymd)
+    fixed_times.append(fixed_time)
+    obs_hours.append(api.dmsToDeg(obs_time, ":")%24)
+    if ra is None or dec is None:
+      ra_hours.append(np.nan)
+      dec_degs.append(np.nan)
+    else:
+      #we pretend we have degrees because conversation hh:mm:ss to XX.XX
+      ra_hours.append(api.dmsToDeg(ra, ":"))
+      dec_degs.append(api.dmsToDeg(dec, ":"))
+  obs_hours, ra_hours, dec_degs = (np.array(obs_hours),
+    np.array(ra_hours), np.array(dec_degs))
+  has_position = ~np.isnan(ra_hours)
+
+  #~~~~~~~~~is the time at night if it is LT?~~~~~~~~~
+  after_midnight = ~((obs_hours>12) & (obs_hours<24))
+  as_lt = (Time([f"{ymd} {t}" for ymd, t in zip(ymds, fixed_times)])
+    +after_midnight.astype(float)*u.day)
+  sunset, sunrise, sun_ok = _sun_set_rise_arrays(
+    [datetime.date.fromisoformat(ymd)+datetime.timedelta(days=1)
+      for ymd in ymds], observatory)
+  at_night = (as_lt>sunset) & (as_lt<sunrise)
+
+  #~~~~~~~~~altitudes under both hypotheses~~~~~~~~~
+  phi = observatory.location.lat.value
+  lst_if_lt = as_lt.sidereal_time("apparent",observatory.location.lon).value+6
+  with np.errstate(invalid="ignore"):
+    altitude_if_lt = get_object_altitude(dec_degs, phi, lst_if_lt-ra_hours)
+    altitude_if_st = get_object_altitude(dec_degs, phi, obs_hours-ra_hours)
+
+  is_lt = at_night & (~has_position | (altitude_if_lt>10))
+  is_lst = ~is_lt & (~has_position | (altitude_if_st>10))
+
+  #~~~~~~~~~local date-times under both hypotheses~~~~~~~~~
+  # LT as in convert_local_date_time_UT
+  lt_local = Time([f"{ymd} {api.hoursToHms(api.dmsToDeg(t, ':')%24)}"
+    for ymd, t in zip(ymds, fixed_times)])+1*u.day
+  # LST as in get_lt_from_st
+  midnights = Time([f"{ymd} 00:00:00" for ymd in ymds])
+  longitude = (76+57/60+57/3600)*u.degree # as in get_sid_delta
+  delta_initial = 6*24/(23+56/60+4/3600)
+  lst_mid = (midnights.sidereal_time('mean',longitude=longitude).value
+    -delta_initial)%24
+  sid_delta = np.array([get_one_sid_delta(lst, t)
+    for lst, t in zip(lst_mid, fixed_times)])
+  st_local = midnights+1*u.day+sid_delta*u.hour
+
+  local = Time(np.where(is_lt, lt_local.jd1, st_local.jd1),
+    np.where(is_lt, lt_local.jd2, st_local.jd2), format="jd")
+  delta_real = get_utc_offsets(local)
+  date_obs = (local-delta_real*u.hour).fits
+
+  for row, index in enumerate(indices):
+    if not sun_ok[row]:
+      continue
+    elif is_lt[row] or is_lst[row]:
+      time_formats[index] = "LT " if is_lt[row] else "LST "
+      dates_obs[index] = str(date_obs[row])
+    else:
+      time_formats[index] = "Neither LT nor ST"
+  return time_formats, dates_obs
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~FITS FILES~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# blank cards we leave before END in headers we write, so later header
+# updates can be done in place (72 cards are two blocks)
+HEADER_RESERVE_CARDS = 72
+
+def serialize_header(hdr, size=None):
+  """
+  returns the astropy header hdr as FITS header bytes.
+
+  Without size, HEADER_RESERVE_CARDS blank cards are added before END
+  (and then the header is padded to full blocks).  With size, the
+  result is padded with blank cards to exactly size bytes; if hdr
+  does not fit into size bytes, None is returned.
+
+  >>> hdr = fits.Header([("OBJECT", "M44")])
+  >>> len(serialize_header(hdr))
+  8640
+  >>> header_bytes = serialize_header(hdr, 2880)
+  >>> len(header_bytes), header_bytes[:8], header_bytes[-80:].strip()
+  (2880, b'OBJECT  ', b'END')
+  >>> for index in range(40):
+  ...   hdr[f"KEY{index}"] = index
+  >>> serialize_header(hdr, 2880) is None
+  True
+  """
+  for card in hdr.cards:
+    card.verify("fix")
+  text = hdr.tostring(sep="", endcard=False, padding=False)
+  cards = [text[offset:offset+80] for offset in range(0, len(text), 80)]
+  while cards and not cards[-1].strip():
+    cards.pop()
+
+  if size is None:
+    n_cards = len(cards)+HEADER_RESERVE_CARDS+1
+    size = -(-n_cards*80//FITS_BLOCK)*FITS_BLOCK
+  n_blank = size//80-len(cards)-1
+  if n_blank<0:
+    return None
+  return ("".join(cards)+" "*80*n_blank+"END".ljust(80)).encode("ascii")
+
+def write_fits_with_header(src_name, dest_name, hdr):
+  """
+  makes dest_name a copy of the FITS file src_name with hdr as its
+  primary header.
+
+  If dest_name already is such a copy (i.e., is newer than src_name
+  and has as many bytes after its primary header) and hdr fits into
+  its header blocks, only these blocks are rewritten.  Otherwise, a new
+  file is written (through a temporary file, so nobody sees a
+  half-written plate), with hdr in front of the data copied from
+  src_name.
+
+  >>> tmpdir = tempfile.mkdtemp()
+  >>> src = os.path.join(tmpdir, "plate.fit")
+  >>> dest = os.path.join(tmpdir, "annotated.fit")
+  >>> fits.PrimaryHDU(np.arange(4, dtype=np.int16)).writeto(src)
+  >>> hdr = fits.getheader(src)
+  >>> hdr["OBJECT"] = "M44"
+  >>> write_fits_with_header(src, dest, hdr)
+  >>> fits.getheader(dest)["OBJECT"], fits.getdata(dest).tolist()
+  ('M44', [0, 1, 2, 3])
+
+  Changing a few cards rewrites the header in place:
+
+  >>> inode = os.stat(dest).st_ino
+  >>> hdr["OBJECT"] = "NGC6611"
+  >>> write_fits_with_header(src, dest, hdr)
+  >>> os.stat(dest).st_ino==inode, fits.getheader(dest)["OBJECT"]
+  (True, 'NGC6611')
+
+  A header that has outgrown the reserve makes for a new file:
+
+  >>> for index in range(2*HEADER_RESERVE_CARDS):
+  ...   hdr.add_comment(f"line {index}")
+  >>> write_fits_with_header(src, dest, hdr)
+  >>> os.stat(dest).st_ino==inode, len(fits.getheader(dest)["COMMENT"])
+  (False, 144)
+
+  And so does a plate rescanned after dest was written:
+
+  >>> fits.PrimaryHDU(np.arange(4, 8, dtype=np.int16)).writeto(src,
+  ...   overwrite=True)
+  >>> os.utime(src, ns=(os.stat(dest).st_mtime_ns+10**9,)*2)
+  >>> write_fits_with_header(src, dest, hdr)
+  >>> fits.getdata(dest).tolist()
+  [4, 5, 6, 7]
+  """
+  with open(src_name, "rb") as src:
+    src_header_size = len(read_header_bytes(src))
+  data_size = os.path.getsize(src_name)-src_header_size
+
+  # a plate rescanned with the same dimensions must not keep the old
+  # pixels, so we only trust copies newer than their source
+  if (os.path.exists(dest_name)
+      and os.stat(dest_name).st_mtime_ns>=os.stat(src_name).st_mtime_ns):
+    with open(dest_name, "r+b") as dest:
+      dest_header_size = len(read_header_bytes(dest))
+      if os.path.getsize(dest_name)-dest_header_size==data_size:
+        header_bytes = serialize_header(hdr, dest_header_size)
+        if header_bytes is not None:
+          dest.seek(0)
+          dest.write(header_bytes)
+          return
+
+  header_bytes = serialize_header(hdr)
+  with replacing(dest_name) as tmp_name:
+    with open(tmp_name, "wb") as dest, open(src_name, "rb") as src:
+      dest.write(header_bytes)
+      src.seek(src_header_size)
+      shutil.copyfileobj(src, dest, 16*1024*1024)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~LOGBOOK~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+LOGBOOK_PATH = "/var/gavo/inputs/logbook_archival/logbook.csv"
+LOGBOOK_CACHE_PATH = os.path.join(CACHE_DIR, "logbook.pickle")
+# bump this when what goes into the logbook cache changes
+LOGBOOK_CACHE_VERSION = 1
+
+def normalize_plate_id(raw_id):
+  """
+  returns the plate id the way we match logbook records and file names
+  (lower case, cyrillic "с" replaced by latin "c").
+
+  >>> normalize_plate_id("14С-3-1")
+  '14c-3-1'
+  """
+  return raw_id.lower().replace("с","c")
+
+
+class LogbookStore:
+  """
+  the observation logbook keyed by normalized plate id.
+
+  Rows are kept as tuples of (interned) strings sharing a single tuple of
+  column names.  Looking up a plate returns a fresh dict, so callers may
+  change it as they like.
+
+  >>> store = LogbookStore.fromCSV(io.StringIO(
+  ...   "ID,OBJECT,EXPTIME\\n14С-3-1,M44,8m\\n15c-1,NGC6611\\n"))
+  >>> store["14c-3-1"]
+  {'ID': '14С-3-1', 'OBJECT': 'M44', 'EXPTIME': '8m'}
+  >>> store["15c-1"]
+  {'ID': '15c-1', 'OBJECT': 'NGC6611', 'EXPTIME': None}
+  >>> len(store), "16c" in store
+  (2, False)
+  """
+  def __init__(self, columns, rows, sha1=None):
+    self.columns, self.rows = tuple(columns), rows
+    self.sha1 = sha1
+
+  @classmethod
+  def fromCSV(cls, f):
+    rdr = csv.reader(f, delimiter=",")
+    columns = tuple(next(rdr))
+    id_index, n_cols = columns.index("ID"), len(columns)
+    rows = {}
+    for raw in rdr:
+      if not raw:
+        continue
+      # like csv.DictReader: short rows are padded with None, extra
+      # values are dropped.
+      row = tuple(sys.intern(v) for v in raw[:n_cols])+(None,)*(n_cols-len(raw))
+      rows[normalize_plate_id(row[id_index])] = row
+    return cls(columns, rows)
+
+  def __getitem__(self, plateid):
+    return dict(zip(self.columns, self.rows[plateid]))
+
+  def __contains__(self, plateid):
+    return plateid in self.rows
+
+  def __len__(self):
+    return len(self.rows)
+
+  def keys(self):
+    return self.rows.keys()
+
+  def values(self):
+    for plateid in self.rows:
+      yield self[plateid]
+
+
+def _read_pickle(path):
+  """
+  returns the unpickled contents of path or None if there is no usable
+  pickle there.
+  """
+  try:
+    with open(path, "rb") as f:
+      return pickle.load(f)
+  except (OSError, EOFError, pickle.UnpicklingError, AttributeError,
+      ValueError):
+    return None
+
+def _write_pickle(path, obj):
+  """
+  atomically replaces path with a pickle of obj.
+  """
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with replacing(path) as tmp_path, open(tmp_path, "wb") as f:
+    pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_logbook(csv_path=LOGBOOK_PATH, cache_path=LOGBOOK_CACHE_PATH):
+  """
+  returns a LogbookStore for the logbook in csv_path.
+
+  The parsed logbook is cached in cache_path.  The cache is used as long
+  as the csv's mtime and size are unchanged; if they changed, we re-parse
+  only if the csv's content hash changed, too.
+  """
+  stat = os.stat(csv_path)
+  stamp = (stat.st_mtime_ns, stat.st_size)
+  cached = _read_pickle(cache_path)
+  if cached and cached.get("version")!=LOGBOOK_CACHE_VERSION:
+    cached = None
+  if cached and cached["stamp"]==stamp:
+    return LogbookStore(cached["columns"], cached["rows"], cached["sha1"])
+
+  with open(csv_path, "rb") as f:
+    raw = f.read()
+  digest = hashlib.sha1(raw).hexdigest()
+  if cached and cached["sha1"]==digest:
+    store = LogbookStore(cached["columns"], cached["rows"])
+  else:
+    store = LogbookStore.fromCSV(
+      io.StringIO(raw.decode("utf-8"), newline=""))
+  store.sha1 = digest
+
+  # plain data only, so the pickle does not depend on the module name
+  _write_pickle(cache_path, {
+    "version": LOGBOOK_CACHE_VERSION,
+    "stamp": stamp,
+    "sha1": digest,
+    "columns": store.columns,
+    "rows": store.rows})
+  return store
+
+NORMALIZED_CACHE_PATH = os.path.join(CACHE_DIR, "logbook-normalized.pickle")
+TIME_FORMATS_CACHE_PATH = os.path.join(CACHE_DIR, "logbook-time-formats.pickle")
+LOGBOOK_REPORT_PATH = os.path.join(CACHE_DIR, "logbook-problems.txt")
+
+# errors our parsers raise on malformed logbook entries
+LOGBOOK_ERRORS = (ValueError, KeyError, AttributeError, IndexError, TypeError)
+
+def blank_to_none(data):
+  """
+  returns a copy of the logbook record data with blank values replaced
+  by None.
+
+  >>> blank_to_none({"RA": " ", "DEC": "", "OBJECT": "M44", "X": "  "})
+  {'RA': None, 'DEC': None, 'OBJECT': 'M44', 'X': None}
+  """
+  return dict((k, None if isinstance(v, str) and v in ("", " ", "  ") else v)
+    for k, v in data.items())
+
+def normalize_logbook_record(data, ra_degs=None, dec_degs=None):
+  """
+  returns a dict with everything _mungeHeader derives from the logbook
+  record data alone (which must have gone through blank_to_none).
+
+  Values that are not given are None.  Values that fail to parse are
+  None, too, and the error messages are in the "errors" entry, a dict
+  mapping logbook columns to messages.
+
+  ra_degs and dec_degs can be items from coordinate_lists_to_deg for
+  data's RA and DEC; if given, the coordinates are not parsed again.
+  """
+  from transliterate import translit #for observer
+  norm, errors = {}, {}
+
+  def from_degs(degs_and_error, formatter):
+    degs, error = degs_and_error
+    if error:
+      raise ValueError(error.split(": ", 1)[-1])
+    return [formatter(deg) for deg in degs]
+
+  def derive(key, column, func):
+    norm[key] = None
+    if data[column]:
+      try:
+        norm[key] = func(data[column])
+      except LOGBOOK_ERRORS as ex:
+        errors[column] = f"{ex.__class__.__name__}: {ex}"
+
+  if ra_degs is None:
+    derive("ra_edit", "RA", reformat_ra) # hh:mm:ss
+  else:
+    derive("ra_edit", "RA", lambda raw: from_degs(ra_degs,
+      lambda deg: api.degToHms(deg, sepChar=":", secondFracs=0)))
+  if dec_degs is None:
+    derive("dec_edit", "DEC", reformat_dec) # dd:mm:ss
+  else:
+    derive("dec_edit", "DEC", lambda raw: from_degs(dec_degs,
+      lambda deg: api.degToDms(deg, sepChar=":", secondFracs=0,
+        preserveLeading=True)))
+  norm["ra_deg"] = norm["ra_edit"] and ra_to_deg(norm["ra_edit"][0])
+  norm["dec_deg"] = norm["dec_edit"] and dec_to_deg(norm["dec_edit"][0])
+
+  derive("tms_lt_edit", "TMS-LT", reformat_time)
+  derive("tme_lt_edit", "TME-LT", reformat_time)
+  derive("tms_lst_edit", "TMS-LST", reformat_time)
+  derive("tme_lst_edit", "TME-LST", reformat_time)
+
+  #returns first date (12-13.02.1987 --> 12.02.1987)
+  derive("date_obs_orig", "DATE-OBS", parse_date_list)
+  derive("date_cards", "DATE-OBS", get_date_cards)
+  derive("exptimes", "EXPTIME", parse_exposure_times)
+  derive("exposure_cards", "EXPTIME", get_exposure_cards)
+
+  derive("observer_edit", "OBSERVER",
+    lambda observer: translit(observer, 'ru', reversed=True))
+  derive("emulsion_edit", "EMULSION", #cause there some ru names
+    lambda emulsion: translit(emulsion, 'ru', reversed=True))
+
+  derive("telescope_edit", "TELESCOPE",
+    lambda telescope: TELESCOPE_ENG[telescope.lower().replace(" ","")])
+  derive("method_edit", "METHOD",
+    lambda method: METHOD_ENG[method.lower().replace(" ","")])
+  #Remove spaces, dots; replace commas and pluses with semicolon; use lower case
+  derive("filters_edit", "FILTER",
+    lambda filters: [FILTERS_ENG["".join(filt.split()).lower()]
+      for filt in filters.replace(" ","").replace(".","").replace(
+        ",",";").replace("+",";").split(";")])
+
+  norm["errors"] = errors
+  return norm
+
+def normalize_logbook(store):
+  """
+  returns a dict mapping plate ids to normalize_logbook_record results
+  for all records in the LogbookStore store.
+  """
+  plateids = list(store.keys())
+  records = [blank_to_none(store[plateid]) for plateid in plateids]
+  # coordinates are parsed column-wise, which is a lot faster than
+  # going through RA_FORMATS and DEC_FORMATS value by value
+  ra_degs = coordinate_lists_to_deg(
+    [rec["RA"] for rec in records], ra_column_to_deg, "RA")
+  dec_degs = coordinate_lists_to_deg(
+    [rec["DEC"] for rec in records], dec_column_to_deg, "Dec")
+  return dict((plateid, normalize_logbook_record(rec, ra_deg, dec_deg))
+    for plateid, rec, ra_deg, dec_deg
+      in zip(plateids, records, ra_degs, dec_degs))
+
+def _code_digest():
+  """
+  returns a hash of this script, so caches of things computed by code
+  in here become stale when the code changes.
+  """
+  with open(os.path.abspath(__file__), "rb") as f:
+    return hashlib.sha1(f.read()).hexdigest()
+
+def load_normalized_logbook(store, cache_path=NORMALIZED_CACHE_PATH):
+  """
+  returns normalize_logbook(store), taking it from cache_path if it was
+  computed from the same logbook with the same code.
+  """
+  key = (store.sha1, _code_digest())
+  cached = _read_pickle(cache_path)
+  if cached and cached["key"]==key:
+    return cached["normalized"]
+  normalized = normalize_logbook(store)
+  _write_pickle(cache_path, {"key": key, "normalized": normalized})
+  return normalized
+
+def load_time_formats(dates, obs_times, ras, decs, observatory,
+    cache_path=TIME_FORMATS_CACHE_PATH):
+  """
+  returns infer_time_formats(dates, obs_times, ras, decs, observatory),
+  taking it from cache_path if it was computed for the same inputs with
+  the same code.
+  """
+  key = (hashlib.sha1(repr((dates, obs_times, ras, decs,
+      observatory.location.lon.deg, observatory.location.lat.deg)
+    ).encode("utf-8")).hexdigest(), _code_digest())
+  cached = _read_pickle(cache_path)
+  if cached and cached["key"]==key:
+    return cached["time_formats"]
+  time_formats = infer_time_formats(dates, obs_times, ras, decs, observatory)
+  _write_pickle(cache_path, {"key": key, "time_formats": time_formats})
+  return time_formats
+
+def report_logbook_problems(normalized, report_path=LOGBOOK_REPORT_PATH):
+  """
+  writes the parse errors in the normalized logbook to report_path and
+  returns the number of records affected.
+  """
+  os.makedirs(os.path.dirname(report_path), exist_ok=True)
+  n_bad = 0
+  with open(report_path, "w", encoding="utf-8") as f:
+    for plateid in sorted(normalized):
+      for column, message in sorted(normalized[plateid]["errors"].items()):
+        f.write(f"{plateid}\t{column}\t{message}\n")
+      n_bad += bool(normalized[plateid]["errors"])
+  return n_bad
+
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 #~~~~~~~~~~~~~~~~~~~TTEESSTT~~~~~~~~~~~~~~~~~~~~~~
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+# modules importing this one must not pull in (see the comment at the
+# imports); astropy.coordinates is not in here because gavo and
+# astropy.time may load it on their own.
+LAZY_MODULES = ["astroquery", "astroplan", "pandas", "transliterate"]
+# seconds importing this module may take, most of which is gavo.api
+IMPORT_TIME_BUDGET = 5
+
+def get_import_profile(module_name="annotate_fits"):
+  """
+  returns the time (in seconds) importing module_name takes in a fresh
+  interpreter and the set of (top-level) modules it imports, as reported
+  by python -X importtime.
+
+  >>> seconds, modules = get_import_profile()
+  >>> seconds<IMPORT_TIME_BUDGET, sorted(modules & set(LAZY_MODULES))
+  (True, [])
+  """
+  import subprocess
+  proc = subprocess.run([sys.executable, "-X", "importtime", "-c",
+      f"import {module_name}"],
+    cwd=os.path.dirname(os.path.abspath(__file__)),
+    capture_output=True, text=True, check=True)
+  # lines look like "import time:   self [us] | cumulative | imported package"
+  seconds, modules = None, set()
+  for line in proc.stderr.splitlines():
+    parts = line.split("|")
+    if not line.startswith("import time:") or len(parts)!=3:
+      continue
+    name = parts[2].strip()
+    modules.add(name.split(".")[0])
+    if name==module_name:
+      seconds = int(parts[1])/1e6
+  return seconds, modules
+
 def run_tests(*args):
   """
   runs all doctests and exits the program.
@@ -1443,6 +2290,467 @@ def run_tests(*args):
   import doctest
   sys.exit(doctest.testmod()[0])
 
+def make_sun_table(*args):
+  """
+  writes the sunset/sunrise table for our observatory and exits the
+  program.
+  """
+  build_sun_table(get_observatory())
+  sys.exit(0)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~SOURCE LISTS~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# if fewer sources than this survive select_sources' cuts, we keep
+# all sources instead
+MIN_SELECTED_SOURCES = 20
+
+def select_sources(sources, max_elongation=1.2, border=0.2, n_keep=100):
+  """
+  returns the n_keep sources with the largest FLUX_AUTO among those that
+  have an ELONGATION below max_elongation and are not within border
+  (a fraction of the plate size) of the edges.
+
+  sources is a record array with (at least) the columns in default.param.
+  The plate size is estimated from the source positions.  Where the cuts
+  leave fewer than MIN_SELECTED_SOURCES, the brightest sources are
+  returned regardless of shape and position.
+
+  >>> sources = np.zeros(40, dtype=[("X_IMAGE", float), ("Y_IMAGE", float),
+  ...   ("FLUX_AUTO", float), ("ELONGATION", float)])
+  >>> sources["X_IMAGE"] = sources["Y_IMAGE"] = np.linspace(0, 100, 40)
+  >>> sources["FLUX_AUTO"] = np.arange(40)
+  >>> sources["ELONGATION"] = 1
+  >>> sources["ELONGATION"][20] = 2
+  >>> select_sources(sources, border=0, n_keep=3)["FLUX_AUTO"].tolist()
+  [39.0, 38.0, 37.0]
+  >>> selected = select_sources(sources, border=0, n_keep=40)
+  >>> len(selected), 20 in selected["FLUX_AUTO"].tolist()
+  (39, False)
+  >>> len(select_sources(sources, border=0.2, n_keep=40))
+  23
+  >>> len(select_sources(sources, border=0.4, n_keep=40))
+  40
+  >>> len(select_sources(sources[:0]))
+  0
+  """
+  if len(sources)==0:
+    return sources
+  x, y = sources["X_IMAGE"], sources["Y_IMAGE"]
+  width, height = x.max(), y.max()
+  mask = ((sources["ELONGATION"]<max_elongation)
+    & (x>=width*border) & (x<=width*(1-border))
+    & (y>=height*border) & (y<=height*(1-border)))
+  if mask.sum()>=MIN_SELECTED_SOURCES:
+    sources = sources[mask]
+  # brightest first, as anet only looks at the first sp_endob sources
+  return sources[np.argsort(-sources["FLUX_AUTO"], kind="stable")[:n_keep]]
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~BINNED EXTRACTION~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def bin_image(src_name, dest_name, factor, strip_rows=256):
+  """
+  writes the primary image of src_name, binned factor x factor by
+  averaging, to dest_name as float32.
+
+  Rows and columns that do not make up a full bin at the right and top
+  edges are dropped.  The input is memory-mapped and binned strip_rows
+  output rows at a time, so we never hold more than a strip of the
+  full-resolution plate in memory.
+
+  >>> tmpdir = tempfile.mkdtemp()
+  >>> fits.PrimaryHDU(np.arange(35, dtype=np.int16).reshape(5, 7)
+  ...   ).writeto(os.path.join(tmpdir, "plate.fit"))
+  >>> bin_image(os.path.join(tmpdir, "plate.fit"),
+  ...   os.path.join(tmpdir, "binned.fit"), 2, strip_rows=1)
+  >>> fits.getdata(os.path.join(tmpdir, "binned.fit")).tolist()
+  [[4.0, 6.0, 8.0], [18.0, 20.0, 22.0]]
+  """
+  with open_plate(src_name) as (header, data, scale):
+    binned = scale(block_reduce(data, factor, strip_rows))
+  fits.PrimaryHDU(binned).writeto(dest_name, overwrite=True)
+
+def rescale_solution(solution, factor):
+  """
+  changes the anet solution (a header or dict of WCS cards) for an
+  image binned factor x factor in place so it applies to the unbinned
+  image.
+
+  Binned pixel b (1-based) is centred on unbinned pixel
+  factor*b-(factor-1)/2; the linear transformation shrinks by factor,
+  and the SIP coefficients of order p+q scale by factor**(1-p-q).
+
+  >>> solution = {"CRPIX1": 100.5, "CRPIX2": 50, "CD1_1": 0.004,
+  ...   "CD2_2": 0.004, "A_ORDER": 2, "A_2_0": 1e-6, "A_1_1": 2e-6,
+  ...   "AP_1_0": 1e-3, "IMAGEW": 1000, "CTYPE1": "RA---TAN-SIP"}
+  >>> rescale_solution(solution, 4)
+  >>> [solution[key] for key in ["CRPIX1", "CRPIX2", "CD1_1", "IMAGEW"]]
+  [400.5, 198.5, 0.001, 4000]
+  >>> solution["A_2_0"], solution["A_1_1"], solution["AP_1_0"]
+  (2.5e-07, 5e-07, 0.001)
+  """
+  for axis in ["1", "2"]:
+    if "CRPIX"+axis in solution:
+      solution["CRPIX"+axis] = (
+        factor*solution["CRPIX"+axis]-(factor-1)/2)
+    if "CDELT"+axis in solution:
+      solution["CDELT"+axis] = solution["CDELT"+axis]/factor
+  for key in ["CD1_1", "CD1_2", "CD2_1", "CD2_2"]:
+    if key in solution:
+      solution[key] = solution[key]/factor
+  for key in ["IMAGEW", "IMAGEH"]:
+    if key in solution:
+      solution[key] = solution[key]*factor
+
+  for key in list(solution.keys()):
+    mat = re.match(r"(A|B|AP|BP)_(\d+)_(\d+)$", key)
+    if mat:
+      order = int(mat.group(2))+int(mat.group(3))
+      solution[key] = solution[key]*factor**(1-order)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~SOLVE CACHE~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+SOLVE_CACHE_DIR = os.path.join(CACHE_DIR, "solutions")
+
+def data_digest(src_name):
+  """
+  returns a sha1 of everything after the primary header of the FITS
+  file src_name, i.e., of the pixels.
+
+  >>> path = os.path.join(tempfile.mkdtemp(), "plate.fit")
+  >>> with open(path, "wb") as f:
+  ...   _ = f.write(b"END".ljust(2880)+b"pixels")
+  >>> data_digest(path)==hashlib.sha1(b"pixels").hexdigest()
+  True
+  """
+  digest = hashlib.sha1()
+  with open(src_name, "rb") as f:
+    read_header_bytes(f)
+    for chunk in iter(lambda: f.read(16*1024*1024), b""):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+class SolveCache:
+  """
+  anet solutions (whatever _runAnet returns) by pixel hash and solver
+  configuration.
+
+  Solutions live in one pickle per key in cache_dir, so pool workers
+  do not get into each other's way.  Failed solves are not cached.
+
+  >>> cache = SolveCache(tempfile.mkdtemp())
+  >>> key = cache.getKey("abc", {"endob": 100}, "DETECT_THRESH 5")
+  >>> cache.get(key)
+  (False, None)
+  >>> cache.put(key, [("CD1_1", 0.001)])
+  >>> cache.get(key)
+  (True, [('CD1_1', 0.001)])
+  >>> key==cache.getKey("abc", {"endob": 50}, "DETECT_THRESH 5")
+  False
+  """
+  def __init__(self, cache_dir=SOLVE_CACHE_DIR):
+    self.cache_dir = cache_dir
+
+  @staticmethod
+  def getKey(pixel_digest, solver_parameters, *more_config):
+    """
+    returns the cache key for a plate with pixel_digest solved with
+    solver_parameters (a dict) and more_config (anything with a stable
+    repr, e.g., the SExtractor control).
+    """
+    config = repr((sorted(solver_parameters.items()), more_config))
+    return hashlib.sha1(f"{pixel_digest}\n{config}".encode("utf-8")
+      ).hexdigest()
+
+  def _getPath(self, key):
+    return os.path.join(self.cache_dir, key[:2], key+".pickle")
+
+  def get(self, key):
+    """
+    returns a pair (found, solution) for key.
+    """
+    solution = _read_pickle(self._getPath(key))
+    if solution is None:
+      return False, None
+    return True, solution
+
+  def put(self, key, solution):
+    if solution:
+      _write_pickle(self._getPath(key), solution)
+
+# logbook coordinates are rough, so we never look in a smaller circle
+SOLVE_HINT_MIN_RADIUS = 1
+# for plates from telescopes whose field we don't know
+SOLVE_HINT_DEFAULT_RADIUS = 10
+
+def get_search_radius(telescope):
+  """
+  returns the radius (in degrees) of the circle around the logbook
+  pointing in which we look for the plate centre.
+
+  That's the side length of the (square) field of telescope according
+  to TELESCOPE_PARAM_DIC, which leaves room for pointings that are off
+  by half a plate.
+
+  >>> round(get_search_radius("Schmidt telescope (large camera)"), 2)
+  6.83
+  >>> get_search_radius("AZT-8"), get_search_radius(None)
+  (1, 10)
+  """
+  field = TELESCOPE_PARAM_DIC.get(telescope, [None]*4)[2]
+  if not field:
+    return SOLVE_HINT_DEFAULT_RADIUS
+  return max(field**0.5, SOLVE_HINT_MIN_RADIUS)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~JOB LEDGER~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+LEDGER_PATH = os.path.join(CACHE_DIR, "ledger.jsonl")
+SOLVE_LOG_PATH = os.path.join(CACHE_DIR, "solve-stages.jsonl")
+
+def append_jsonl(path, entry):
+  """
+  appends entry as a line of JSON to path.
+
+  The line goes out in a single write, so several processes can
+  append to the same file.
+  """
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path, "a", encoding="utf-8") as f:
+    f.write(json.dumps(entry)+"\n")
+
+class JobLedger:
+  """
+  an append-only log of what happened to which plate.
+
+  Each line is a JSON object with source, state, input (see fingerprint),
+  time, and, for finished plates, duration and error.  States are
+  pending (started), solved (anet is through), munged (the annotated
+  plate is written; that's the end) and failed.  The last line for a
+  plate wins.
+
+  Lines are appended with a single write each, so several worker
+  processes can share the file.
+
+  >>> path = os.path.join(tempfile.mkdtemp(), "ledger.jsonl")
+  >>> ledger = JobLedger(path)
+  >>> ledger.record("a.fit", "pending", "1:1")
+  >>> ledger.record("a.fit", "munged", "1:1", duration=3.5)
+  >>> ledger.record("b.fit", "failed", "1:1", error="KeyError: 'x'")
+  >>> ledger = JobLedger(path)
+  >>> ledger.isDone("a.fit", "1:1"), ledger.isDone("a.fit", "2:1")
+  (True, False)
+  >>> ledger.isDone("b.fit", "1:1"), ledger.states["b.fit"]["error"]
+  (False, "KeyError: 'x'")
+  """
+  def __init__(self, path=LEDGER_PATH):
+    self.path = path
+    self.states = {}
+    if os.path.exists(path):
+      with open(path, encoding="utf-8") as f:
+        for line in f:
+          try:
+            entry = json.loads(line)
+          except ValueError: # half-written line from a killed run
+            continue
+          self.states[entry["source"]] = entry
+
+  @staticmethod
+  def fingerprint(src_name):
+    """
+    returns a string that changes when src_name is replaced or
+    modified.
+
+    This only stats the file; hashing the plates would mean reading
+    all of them, which is what the ledger is there to avoid.
+    """
+    st = os.stat(src_name)
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+  def record(self, src_name, state, fingerprint, duration=None,
+      error=None):
+    entry = {"source": src_name, "state": state, "input": fingerprint,
+      "time": time.time()}
+    if duration is not None:
+      entry["duration"] = round(duration, 2)
+    if error is not None:
+      entry["error"] = error
+    self.states[src_name] = entry
+    append_jsonl(self.path, entry)
+
+  def isDone(self, src_name, fingerprint):
+    """
+    returns True if src_name has been munged and not changed since.
+    """
+    entry = self.states.get(src_name)
+    return (entry is not None
+      and entry["state"]=="munged"
+      and entry["input"]==fingerprint)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~STAGE TIMING~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+TIMING_LOG_PATH = os.path.join(CACHE_DIR, "munge-timings.jsonl")
+
+class StageTimer:
+  """
+  wall clock time spent in the consecutive stages of processing a plate.
+
+  Each start ends the stage running before; stop ends the last one and
+  returns a dict mapping stage names to seconds.
+
+  >>> timer = StageTimer()
+  >>> timer.start("coordinates"); timer.start("write")
+  >>> timer.start("coordinates")
+  >>> sorted(timer.stop()), timer.current
+  (['coordinates', 'write'], None)
+  """
+  def __init__(self):
+    self.spans = {}
+    self.current, self.started = None, None
+
+  def start(self, stage):
+    now = time.perf_counter()
+    if self.current is not None:
+      self.spans[self.current] = (self.spans.get(self.current, 0)
+        +now-self.started)
+    self.current, self.started = stage, now
+
+  def stop(self):
+    self.start(None)
+    return self.spans
+
+def summarize_timings(run_id, path=TIMING_LOG_PATH):
+  """
+  returns a dict mapping stage names to dicts with the number of plates,
+  total, mean, median and 95th percentile seconds of the stage in the
+  run run_id as logged in path.
+
+  >>> path = os.path.join(tempfile.mkdtemp(), "timings.jsonl")
+  >>> for spans in [{"write": 1}, {"write": 3}, {"coordinates": 0.5}]:
+  ...   append_jsonl(path, {"run": "r1", "spans": spans})
+  >>> append_jsonl(path, {"run": "r0", "spans": {"write": 100}})
+  >>> summary = summarize_timings("r1", path)
+  >>> summary["write"]["plates"], summary["write"]["total"], summary["write"]["median"]
+  (2, 4, 2.0)
+  """
+  by_stage = {}
+  if os.path.exists(path):
+    with open(path, encoding="utf-8") as f:
+      for line in f:
+        try:
+          entry = json.loads(line)
+        except ValueError:
+          continue
+        if entry.get("run")==run_id:
+          for stage, seconds in entry["spans"].items():
+            by_stage.setdefault(stage, []).append(seconds)
+
+  summary = {}
+  for stage, durations in by_stage.items():
+    durations.sort()
+    summary[stage] = {
+      "plates": len(durations),
+      "total": sum(durations),
+      "mean": sum(durations)/len(durations),
+      "median": float(np.percentile(durations, 50)),
+      "p95": float(np.percentile(durations, 95))}
+  return summary
+
+def print_timing_summary(summary):
+  """
+  prints a table of the stage timings in summary (as returned by
+  summarize_timings), the most expensive stage first.
+  """
+  if not summary:
+    return
+  grand_total = sum(stats["total"] for stats in summary.values()) or 1
+  print(f"{'stage':14s} {'plates':>7s} {'total/s':>9s} {'share':>6s}"
+    f" {'mean/s':>8s} {'median/s':>9s} {'p95/s':>8s}")
+  for stage, stats in sorted(summary.items(),
+      key=lambda item: -item[1]["total"]):
+    print(f"{stage:14s} {stats['plates']:7d} {stats['total']:9.1f}"
+      f" {stats['total']/grand_total:6.1%} {stats['mean']:8.3f}"
+      f" {stats['median']:9.3f} {stats['p95']:8.3f}")
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~PARALLEL RUNS~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+RUN_REPORT_PATH = os.path.join(CACHE_DIR, "last-run.tsv")
+
+# the processor the pool workers use; set in the parent before forking,
+# so each worker inherits platemeta & co. instead of loading it again
+_pool_processor = None
+
+def _init_pool_worker():
+  _pool_processor._afterFork()
+
+def _process_in_worker(src_name):
+  """
+  processes src_name in a pool worker and returns a triple (src_name,
+  error message or None, seconds spent).
+  """
+  started = time.time()
+  try:
+    _pool_processor.process(src_name)
+    return src_name, None, time.time()-started
+  except Exception as ex:
+    return src_name, f"{ex.__class__.__name__}: {ex}", time.time()-started
+
+def run_in_pool(processor, src_names, workers, report_path=RUN_REPORT_PATH):
+  """
+  runs processor.process on all src_names in workers forked processes
+  and returns (processed, ignored) like DaCHS' processAll.
+
+  anet and SExtractor run in temporary working directories, which is why
+  we need processes rather than threads here.  Plates that would end up
+  in the same output file are not run concurrently; all but the first
+  of them are reported as failures.  Per-plate outcomes and timings go
+  to report_path as tab-separated values.
+  """
+  global _pool_processor
+  by_dest, duplicates = {}, []
+  for src_name in src_names:
+    dest = plate_file_name(src_name)
+    if dest in by_dest:
+      duplicates.append((src_name,
+        f"Output {dest} already written from {by_dest[dest]}", 0))
+    else:
+      by_dest[dest] = src_name
+
+  _pool_processor = processor
+  results = list(duplicates)
+  started = time.time()
+  with multiprocessing.get_context("fork").Pool(workers,
+      initializer=_init_pool_worker) as pool:
+    for n_done, result in enumerate(pool.imap_unordered(
+        _process_in_worker, list(by_dest.values())), 1):
+      results.append(result)
+      if result[1]:
+        print(f"FAILED {result[0]}: {result[1]}")
+      if n_done%50==0:
+        print(f"{n_done}/{len(by_dest)} plates done"
+          f" after {time.time()-started:.0f} s")
+
+  os.makedirs(os.path.dirname(report_path), exist_ok=True)
+  with open(report_path, "w", encoding="utf-8") as f:
+    f.write("source\tseconds\terror\n")
+    for src_name, error, duration in sorted(results):
+      f.write(f"{src_name}\t{duration:.1f}\t{error or ''}\n")
+
+  ignored = sum(1 for _, error, _ in results if error)
+  print(f"{len(results)} plates in {time.time()-started:.0f} s with"
+    f" {workers} workers, {ignored} failed; see {report_path}")
+  return len(results), ignored
+
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 #~~~~~~~~~~~~~~~~~HEADER CLASS~~~~~~~~~~~~~~~~~~~~
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -1454,6 +2762,8 @@ class PAHeaderAdder(api.AnetHeaderProcessor):
   sp_upper_pix = 6 #the largest permissible pixel size in arcsecs
   sp_endob = 100 # last object to be processed
   sp_indices = ["index-41[01]*.fits"]# The file names from anet’s index directory you want to have used
+  filterMaxElongation = 1.2 # rounder sources are probably stars
+  filterBorder = 0.2 # fraction of the plate at each edge we don't trust
 
   sourceExtractorControl = """
     DETECT_MINAREA   20
@@ -1463,45 +2773,94 @@ class PAHeaderAdder(api.AnetHeaderProcessor):
   #DETECT_THRESH 5 (SIGNAL 5SIGMA ABOVE THE NOISE IS SOURSE)
   #SEEING_FWHM 1.2 (IDK)
 
+  # we first extract sources on a binned copy of the plate; stars cover
+  # extractionBinning**2 times fewer pixels there
+  extractionBinning = 4
+  binnedSourceExtractorControl = """
+    DETECT_MINAREA   3
+    DETECT_THRESH    5
+    SEEING_FWHM      1.2
+  """
+  # with fewer sources on the binned plate, we extract at full resolution
+  minBinnedSources = 50
+  # seconds anet gets at most in each stage of the solve ladder; all
+  # stages together never get more than sp_total_timelimit
+  stageTimelimits = {"hinted": 30, "hinted-wide": 60,
+    "blind": sp_total_timelimit}
+
   def __init__(self, *args, **kwargs):
     super().__init__(*args, **kwargs)  # Вызов конструктора родительского класса
-    self.fits_file = None  # Добавление своей переменной
     self.fits_name = None  # Добавление своей переменной
+    self.src_name = None # the plate we are working on
+    self.n_extracted = None # number of sources in the last SExtractor run
+    # tags this run's lines in TIMING_LOG_PATH; pool workers inherit it
+    self.run_id = f"{time.time():.0f}-{os.getpid()}"
 
   @staticmethod
   def addOptions(optParser):
     api.AnetHeaderProcessor.addOptions(optParser)
     optParser.add_option("--test", help="Run unit tests, then exit",
       action="callback", callback=run_tests)
+    optParser.add_option("--build-sun-table", help="Compute the sunset/"
+      f"sunrise table ({SUN_TABLE_PATH}), then exit",
+      action="callback", callback=make_sun_table)
+    optParser.add_option("--simbad-offline", help="Do not query Simbad,"
+      " use only names already in the resolver cache",
+      action="store_true", dest="simbadOffline", default=False)
+    optParser.add_option("--simbad-ttl", help="Re-query Simbad for cached"
+      " names older than DAYS (default %default)", metavar="DAYS",
+      action="store", dest="simbadTTL", type="float", default=SIMBAD_TTL)
+    optParser.add_option("--simbad-workers", help="Resolve up to N object"
+      " names concurrently before processing (default %default)",
+      metavar="N", action="store", dest="simbadWorkers", type="int",
+      default=SIMBAD_WORKERS)
+    optParser.add_option("--ignore-solve-cache", help="Run anet even"
+      " for plates with a cached solution (and update the cache)",
+      action="store_true", dest="ignoreSolveCache", default=False)
+    optParser.add_option("--extraction-binning", help="Bin plates N x N"
+      " for source extraction, 1 to always use full resolution (default"
+      " %default)", metavar="N", action="store", dest="extractionBinning",
+      type="int", default=PAHeaderAdder.extractionBinning)
+    optParser.add_option("--workers", help="Process plates in N parallel"
+      " processes (default %default)", metavar="N", action="store",
+      dest="workers", type="int", default=1)
 
   def _createAuxiliaries(self, dd):
-    log_path = os.path.join(dd.rd.resdir, "/var/gavo/inputs/logbook_archival", "logbook.csv")
-    with open(log_path, "r", encoding="utf-8") as f:
-      rdr = csv.DictReader(f, delimiter=",")
-      self.platemeta = dict((rec["ID"].lower().replace("с","c"), rec) for rec in rdr)
-      #identification by identification number
+    self.platemeta = load_logbook()
+    #identification by identification number
+    self.normalized = load_normalized_logbook(self.platemeta)
+    n_bad = report_logbook_problems(self.normalized)
+    if n_bad:
+      print(f"{n_bad} logbook records failed to parse, see {LOGBOOK_REPORT_PATH}")
+    self.simbad = SimbadCache(SIMBAD_CACHE_PATH,
+      ttl=self.opts.simbadTTL, offline=self.opts.simbadOffline)
+    # resolve every distinct name once, up front, so _mungeHeader only
+    # ever sees cache hits
+    self.simbad.prefetch(iter_object_names(self.platemeta),
+      workers=self.opts.simbadWorkers)
+    # LT or LST? decided for the whole logbook at once
+    self.time_formats = self._inferTimeFormats()
+    self.ledger = JobLedger()
+    self.solve_cache = SolveCache()
   
-  def NOobjectFilter(self, inName):
-    """throws out funny-looking objects from inName as well as objects
-    near the border.
+  def objectFilter(self, inName):
     """
-    
-
-    width = max(data_fits.field("X_IMAGE"))
-    height = max(data_fits.field("Y_IMAGE"))
-    badBorder = 0.2
-    data_fits = data_fits[data_fits.field("ELONGATION")<1.2]
-    data_fits = data_fits[data_fits.field("X_IMAGE")>width*badBorder]
-    data_fits = data_fits[data_fits.field("X_IMAGE")<width-width*badBorder]
-    data_fits = data_fits[data_fits.field("Y_IMAGE")>height*badBorder]
-    data_fits = data_fits[data_fits.field("Y_IMAGE")<height-height*badBorder]
-
-    # the extra np.array below works around a bug in several versions
-    # of pyfits that would write the full, not the filtered array
-    hdu = api.pyfits.BinTableHDU(np.array(data_fits))
-    hdu.writeto("foo.xyls")
-    hdulist.close()
-    os.rename("foo.xyls", inName)
+    replaces the SExtractor source list inName with the sp_endob
+    brightest sources that look like stars, as per select_sources.
+    """
+    with fits.open(inName) as hdus:
+      sources = hdus[1].data
+      self.n_extracted = len(sources)
+      selected = np.array(select_sources(sources,
+        max_elongation=self.filterMaxElongation, border=self.filterBorder,
+        n_keep=self.sp_endob))
+      header = hdus[1].header
+
+    # anet runs us in its own working directory, but let's not rely on
+    # that: the temporary file goes next to inName and gets a unique name
+    with replacing(inName, suffix=".xyls") as tmp_name:
+      fits.BinTableHDU(selected, header=header).writeto(tmp_name,
+        overwrite=True)
 
   def _shouldRunAnet(self, srcName, header):
     #try:
@@ -1519,29 +2878,456 @@ class PAHeaderAdder(api.AnetHeaderProcessor):
     #    print(f"An error occurred for {srcName}: {e}")
         # Optionally, log the error or take other actions if needed.
 
-  def _isProcessed(self, srcName):
-    hdr = self.getPrimaryHeader(srcName)
-    self.fits_file = fits.open(srcName)
+  def _runAnet(self, srcName):
+    """
+    returns the anet solution for srcName, from the solve cache if we
+    solved the same pixels with the same configuration before.
+
+    >>> import types
+    >>> from unittest import mock
+    >>> class FakeAnet(api.AnetHeaderProcessor):
+    ...   def _runAnet(self, srcName):
+    ...     solved.append(srcName)
+    ...     self.n_extracted = self.fake_sources
+    ...     return self.fake_solution
+    >>> class StubbedAdder(PAHeaderAdder, FakeAnet):
+    ...   pass
+    >>> tmpdir, solved = tempfile.mkdtemp(), []
+    >>> plate = os.path.join(tmpdir, "fai50_1c.fit")
+    >>> fits.PrimaryHDU(np.zeros((8, 8), dtype=np.int16)).writeto(plate)
+    >>> proc = StubbedAdder.__new__(StubbedAdder)
+    >>> proc.fake_solution, proc.fake_sources = [("CD1_1", 0.001)], None
+    >>> proc.opts = types.SimpleNamespace(ignoreSolveCache=False,
+    ...   extractionBinning=1)
+    >>> proc.platemeta, proc.normalized, proc.n_extracted = {}, {}, None
+    >>> proc.solve_cache = SolveCache(os.path.join(tmpdir, "solutions"))
+    >>> module = sys.modules[__name__]
+    >>> with mock.patch.object(module, "SOLVE_LOG_PATH",
+    ...     os.path.join(tmpdir, "stages.jsonl")):
+    ...   first = proc._runAnet(plate)
+    ...   second = proc._runAnet(plate)
+    >>> first, second==first, solved==[plate]
+    ([('CD1_1', 0.001)], True, True)
+
+    Solutions found with other binning are not reused:
+
+    >>> key = proc._getSolveKey(plate)
+    >>> proc.opts.extractionBinning = 4
+    >>> proc._getSolveKey(plate)==key
+    False
+
+    A plate is binned once, however many stages of the solve ladder it
+    goes through:
+
+    >>> proc.fake_solution, solved[:] = None, []
+    >>> proc.opts = types.SimpleNamespace(ignoreSolveCache=True,
+    ...   extractionBinning=2)
+    >>> proc._getSolveHint = lambda srcName: (120.0, 20.0, 5.0)
+    >>> with mock.patch.object(module, "SOLVE_LOG_PATH", # doctest: +ELLIPSIS
+    ...     os.path.join(tmpdir, "stages.jsonl")), mock.patch.object(
+    ...     module, "bin_image", wraps=bin_image) as binner:
+    ...   proc._runAnet(plate)
+    No solution for ...fai50_1c.fit in stage hinted
+    No solution for ...fai50_1c.fit in stage hinted-wide
+    No solution for ...fai50_1c.fit in stage blind
+    >>> binner.call_count, len(solved), len(set(solved)), plate in solved
+    (1, 3, 1, False)
+
+    If the binned copy has too few sources, the first stage switches to
+    full resolution, and the later stages do not try the copy again:
+
+    >>> proc.fake_sources, solved[:] = 3, []
+    >>> with mock.patch.object(module, "SOLVE_LOG_PATH", # doctest: +ELLIPSIS
+    ...     os.path.join(tmpdir, "stages.jsonl")):
+    ...   proc._runAnet(plate)
+    Only 3 sources on binned ...fai50_1c.fit, extracting at full resolution
+    No solution for ...fai50_1c.fit in stage hinted
+    No solution for ...fai50_1c.fit in stage hinted-wide
+    No solution for ...fai50_1c.fit in stage blind
+    >>> [name==plate for name in solved]
+    [False, True, True, True]
+    """
+    key = self._getSolveKey(srcName)
+    if not self.opts.ignoreSolveCache:
+      found, solution = self.solve_cache.get(key)
+      if found:
+        return solution
+    with self._binnedCopy(srcName) as binned_name:
+      solution = self._solveInStages(srcName, binned_name)
+    self.solve_cache.put(key, solution)
+    return solution
+
+  def _getSolveKey(self, srcName):
+    """
+    returns the solve cache key for srcName with our current solver and
+    extraction configuration.
+
+    Binning changes what anet sees (and how we rescale its solution),
+    so the binning configuration is part of the key.
+    """
+    return self.solve_cache.getKey(data_digest(srcName),
+      self.solverParameters, self.sourceExtractorControl,
+      self.indexPath, self.opts.extractionBinning,
+      self.binnedSourceExtractorControl, self.minBinnedSources)
+
+  @contextlib.contextmanager
+  def _binnedCopy(self, srcName):
+    """
+    a context manager yielding the name of a temporary copy of srcName
+    binned as per --extraction-binning, or None if we extract at full
+    resolution.
+    """
+    factor = self.opts.extractionBinning
+    if factor<2:
+      yield None
+      return
+    tmpdir = tempfile.mkdtemp(prefix="binned-")
+    try:
+      binned_name = os.path.join(tmpdir, os.path.basename(srcName))
+      bin_image(srcName, binned_name, factor)
+      yield binned_name
+    finally:
+      shutil.rmtree(tmpdir, ignore_errors=True)
+
+  def _getSolveHint(self, srcName):
+    """
+    returns ra, dec, radius (all degrees) around which to look for the
+    solution for srcName, or None if we don't know where the plate
+    points.
+    """
+    plateid = self._getPlateId(srcName)
+    if plateid not in self.platemeta or plateid not in self.normalized:
+      return None
+    norm = self.normalized[plateid]
+    _, ra_deg, _, dec_deg = self._getPointing(
+      blank_to_none(self.platemeta[plateid]), norm)
+    if ra_deg is None or dec_deg is None:
+      return None
+    return ra_deg, dec_deg, get_search_radius(norm["telescope_edit"])
+
+  def _iterSolveStages(self, hint):
+    """
+    iterates over (name, attribute overrides) for the stages of the
+    solve ladder for a plate with the solve hint hint (which may be None).
+
+    With ra, dec and radius, solve-field only loads the index healpixes
+    near the pointing, which is much faster than trying them all; that's
+    why we try that first, and give the blind solve more sources.
+
+    The stages split sp_total_timelimit between them, each getting its
+    stageTimelimits entry at most; the blind solve gets what is left.
+
+    >>> proc = PAHeaderAdder.__new__(PAHeaderAdder)
+    >>> [(name, overrides["sp_total_timelimit"])
+    ...   for name, overrides in proc._iterSolveStages((83.6, 22.0, 5.0))]
+    [('hinted', 30), ('hinted-wide', 60), ('blind', 90)]
+    >>> [(name, overrides["sp_total_timelimit"])
+    ...   for name, overrides in proc._iterSolveStages(None)]
+    [('blind', 180)]
+    >>> proc.stageTimelimits = {"hinted": 150, "hinted-wide": 150,
+    ...   "blind": 150}
+    >>> [sum(overrides["sp_total_timelimit"]
+    ...   for _, overrides in proc._iterSolveStages(hint))
+    ...   for hint in [(83.6, 22.0, 5.0), None]]
+    [180, 150]
+    """
+    stages = []
+    if hint is not None:
+      ra, dec, radius = hint
+      stages.append(("hinted", dict(sp_ra=ra, sp_dec=dec, sp_radius=radius)))
+      stages.append(("hinted-wide", dict(sp_ra=ra, sp_dec=dec,
+        sp_radius=2*radius, sp_lower_pix=self.sp_lower_pix/2,
+        sp_upper_pix=self.sp_upper_pix*2)))
+    stages.append(("blind", dict(sp_endob=3*self.sp_endob)))
+
+    budget = self.sp_total_timelimit
+    for name, overrides in stages:
+      limit = min(self.stageTimelimits[name], budget)
+      if limit<=0:
+        return
+      budget -= limit
+      overrides["sp_total_timelimit"] = limit
+      yield name, overrides
+
+  def _solveInStages(self, srcName, binned_name):
+    """
+    goes down the solve ladder for srcName until a stage yields a
+    solution and returns that (or None if we give up).
+
+    binned_name is what _binnedCopy made for srcName.  Whether we
+    solve on that or at full resolution is decided once, in the first
+    stage (see _extractAndSolve), and the later stages stick to it.
+    Each stage is logged to SOLVE_LOG_PATH.
+    """
+    for stage, overrides in self._iterSolveStages(
+        self._getSolveHint(srcName)):
+      started, error, solution = time.time(), None, None
+      try:
+        with self._temporarily(**overrides):
+          solution, binned_name = self._extractAndSolve(
+            srcName, binned_name)
+      except Exception as ex:
+        error = f"{ex.__class__.__name__}: {ex}"
+        print(f"{stage} solve of {srcName} crashed: {error}")
+      append_jsonl(SOLVE_LOG_PATH, {"source": srcName, "stage": stage,
+        "solved": bool(solution), "seconds": round(time.time()-started, 1),
+        "sources": self.n_extracted, "error": error})
+      if solution:
+        return solution
+      print(f"No solution for {srcName} in stage {stage}")
+    return None
+
+  @contextlib.contextmanager
+  def _temporarily(self, **attrs):
+    """
+    a context manager overriding attributes (sp_*, the extractor control)
+    for the anet runs within it.
+    """
+    saved = dict((name, self.__dict__[name])
+      for name in attrs if name in self.__dict__)
+    self.__dict__.update(attrs)
+    try:
+      yield
+    finally:
+      for name in attrs:
+        self.__dict__.pop(name, None)
+      self.__dict__.update(saved)
+
+  def _extractAndSolve(self, srcName, binned_name):
+    """
+    returns the anet solution for srcName (or None) and the binned copy
+    later stages should solve on.
+
+    binned_name is the binned copy of srcName, or None to solve at full
+    resolution.  If SExtractor does not find minBinnedSources sources
+    on the copy, we solve srcName itself and return None as the copy,
+    so the remaining stages go to full resolution directly.
+    """
+    if binned_name is None:
+      return super()._runAnet(srcName), None
+
+    factor = self.opts.extractionBinning
+    self.n_extracted = None
+    with self._temporarily(
+        sp_lower_pix=self.sp_lower_pix*factor,
+        sp_upper_pix=self.sp_upper_pix*factor,
+        sourceExtractorControl=self.binnedSourceExtractorControl):
+      solution = super()._runAnet(binned_name)
+
+    if solution:
+      rescale_solution(solution, factor)
+      return solution, binned_name
+    if self.n_extracted is not None and self.n_extracted<self.minBinnedSources:
+      print(f"Only {self.n_extracted} sources on binned {srcName},"
+        " extracting at full resolution")
+      return super()._runAnet(srcName), None
+    return solution, binned_name
+
+  @staticmethod
+  def getPrimaryHeader(srcName):
+    """
+    returns the primary header of srcName, reading nothing but the
+    header blocks.
+
+    As with fits.open, non-ASCII bytes in the header do not stop us:
+
+    >>> path = os.path.join(tempfile.mkdtemp(), "plate.fit")
+    >>> hdu = fits.PrimaryHDU(np.zeros((2, 2), dtype=np.int16))
+    >>> hdu.header["OBJECT"], hdu.header["RA-ORIG"] = "M31", "00:42:44"
+    >>> hdu.writeto(path)
+    >>> with open(path, "r+b") as f:
+    ...   raw = f.read(FITS_BLOCK)
+    ...   _ = f.seek(0)
+    ...   _ = f.write(raw.replace(b"'M31", b"'M\\xe91"))
+    >>> "RA-ORIG" in PAHeaderAdder.getPrimaryHeader(path)
+    True
+    """
+    with open(srcName, "rb") as f:
+      # astropy decodes bytes itself, replacing what is not ASCII
+      return fits.Header.fromstring(read_header_bytes(f))
+
+  def _setSource(self, srcName):
+    """
+    makes srcName the plate we are working on.
+    """
+    if srcName==self.src_name:
+      return
+    self.src_name = srcName
     if "/" in srcName: 
-      self.fits_name = srcName.split("/")[-1].replace("–","-").encode("utf-8").decode("utf-8") 
+      self.fits_name = plate_file_name(srcName)
       print(self.fits_name)
+
+  def process(self, srcName):
+    """
+    processes srcName unless the ledger says it is done already.
+
+    Plates that failed or were interrupted last time are retried;
+    --reprocess ignores the ledger.  With --apply, processing changes
+    srcName itself, so "munged" is recorded with the fingerprint of the
+    result.
+
+    >>> import types
+    >>> class FakeProcessor(api.AnetHeaderProcessor):
+    ...   def process(self, srcName):
+    ...     processed.append(srcName)
+    ...     with open(srcName, "ab") as f: # as --apply does
+    ...       _ = f.write(b"new header")
+    >>> class StubbedAdder(PAHeaderAdder, FakeProcessor):
+    ...   pass
+    >>> tmpdir, processed = tempfile.mkdtemp(), []
+    >>> plate = os.path.join(tmpdir, "fai50_1c.fit")
+    >>> with open(plate, "wb") as f:
+    ...   _ = f.write(b"plate")
+    >>> proc = StubbedAdder.__new__(StubbedAdder)
+    >>> proc.opts = types.SimpleNamespace(reProcess=False)
+    >>> proc.ledger = JobLedger(os.path.join(tmpdir, "ledger.jsonl"))
+    >>> proc.process(plate)
+    >>> proc.process(plate)
+    >>> len(processed)
+    1
+    """
+    fingerprint = self.ledger.fingerprint(srcName)
+    if not self.opts.reProcess and self.ledger.isDone(srcName, fingerprint):
+      return
+    self.ledger.record(srcName, "pending", fingerprint)
+    started = time.time()
+    try:
+      super().process(srcName)
+    except Exception as ex:
+      self.ledger.record(srcName, "failed", fingerprint, time.time()-started,
+        f"{ex.__class__.__name__}: {ex}")
+      raise
+    self.ledger.record(srcName, "munged", self.ledger.fingerprint(srcName),
+      time.time()-started)
+
+  def processAll(self):
+    if self.opts.workers<2:
+      result = super().processAll()
+    else:
+      result = run_in_pool(self, list(self.iterIdentifiers()), self.opts.workers)
+    print_timing_summary(summarize_timings(self.run_id))
+    return result
+
+  def _afterFork(self):
+    """
+    drops what a forked worker must not share with its parent.
+    """
+    self.simbad.reconnect()
+    self.src_name = None
+
+  def _isProcessed(self, srcName):
+    self._setSource(srcName)
+    hdr = self.getPrimaryHeader(srcName)
     return "RA-ORIG" in hdr and "A_ORDER" in hdr
 
+  @staticmethod
+  def _getPlateId(srcName):
+    return normalize_plate_id(srcName.split(".")[-2].split("_")[-1])
+
+  def _getPointing(self, data, norm):
+    """
+    returns ra_edit, ra_deg, dec_edit, dec_deg for the (blanked) logbook
+    record data with its normalized values norm.
+
+    Coordinates come from the logbook if they are there, else from Simbad
+    (which after _createAuxiliaries means: from the Simbad cache).
+    """
+    ra, dec, obj_name = data["RA"], data["DEC"], data["OBJECT"]
+    #~~~~~~~~~SIMBAD-QUERY~~~~~~~~~
+    ra_simbad = []
+    dec_simbad = []
+    if obj_name and not (ra and dec):
+      for obj in obj_name.replace(",",";").split(";"):
+        position = self.simbad.resolve(obj)
+        if position:#if object data there is in Simbad
+          ra_simbad.append(position[0])
+          dec_simbad.append(position[1])
+        else:#if not
+          ra_simbad.append(None)
+          dec_simbad.append(None)
+
+    ra_simbad = [ra_s for ra_s in ra_simbad if str(ra_s) != 'nan']
+    dec_simbad = [dec_s for dec_s in dec_simbad if str(dec_s) != 'nan']
+
+    if len(ra_simbad)==0:
+      ra_simbad = None
+      dec_simbad = None
+
+    #~~~~~~~~~COORDS EDITED~~~~~~~~~
+    if ra:#if there is data in obs log
+      ra_edit, ra_deg = norm["ra_edit"], norm["ra_deg"] # hh:mm:ss
+    elif ra_simbad:#if there is data in Simbad
+      ra_edit = ra_simbad#list of hh:mm:ss format ra
+      ra_deg = ra_to_deg(ra_edit[0])
+    else:#if there is not data in Simbad
+      ra_edit, ra_deg = None, None#there is no data in neither obs log or Simbad
+    if dec:#if there is data in obs log
+      dec_edit, dec_deg = norm["dec_edit"], norm["dec_deg"] # dd:mm:ss
+    elif dec_simbad:#if there is data in Simbad
+      dec_edit = dec_simbad#list of hh:mm:ss format ra
+      dec_deg = dec_to_deg(dec_edit[0])
+    else:#if there is not data in Simbad
+      dec_edit, dec_deg = None, None#there is no data in neither obs log or Simbad
+    return ra_edit, ra_deg, dec_edit, dec_deg
+
+  def _inferTimeFormats(self):
+    """
+    returns a dict mapping plate ids to (time_format, date_obs_edit)
+    for all logbook records that have a date and a time, computed in
+    one go by infer_time_formats (or taken from its cache).
+    """
+    plateids, dates, obs_times, ras, decs = [], [], [], [], []
+    for plateid, norm in self.normalized.items():
+      times = norm["tms_lt_edit"] or norm["tms_lst_edit"]
+      if norm["errors"] or not times or not norm["date_obs_orig"]:
+        continue
+      ra_edit, _, dec_edit, _ = self._getPointing(
+        blank_to_none(self.platemeta[plateid]), norm)
+      plateids.append(plateid)
+      dates.append(norm["date_obs_orig"][0])
+      obs_times.append(times[0])
+      ras.append(ra_edit[0] if ra_edit else None)
+      decs.append(dec_edit[0] if dec_edit else None)
+
+    if not plateids:
+      return {}
+    time_formats, dates_obs = load_time_formats(
+      dates, obs_times, ras, decs, get_observatory(), TIME_FORMATS_CACHE_PATH)
+    return dict((plateid, (time_format, date_obs))
+      for plateid, time_format, date_obs in zip(plateids, time_formats, dates_obs)
+      if time_format is not None)
+
   def _mungeHeader(self, srcName, hdr):
-    plateid = srcName.split(".")[-2].split("_")[-1].lower().replace("с","c")
+    """
+    returns the header for srcName, logging how long the stages of
+    making it took to TIMING_LOG_PATH.
+    """
+    timer, failed = StageTimer(), True
+    try:
+      new_hdr = self._buildHeader(srcName, hdr, timer)
+      failed = False
+      return new_hdr
+    finally:
+      spans = timer.stop()
+      append_jsonl(TIMING_LOG_PATH, {"run": self.run_id, "source": srcName,
+        "failed": failed, "total": round(sum(spans.values()), 4),
+        "spans": dict((stage, round(seconds, 4))
+          for stage, seconds in spans.items())})
+
+  def _buildHeader(self, srcName, hdr, timer):
+    timer.start("logbook")
+    self._setSource(srcName) # _isProcessed is skipped with --reprocess
+    # we only get here once anet is through with the plate
+    self.ledger.record(srcName, "solved", self.ledger.fingerprint(srcName))
+    plateid = self._getPlateId(srcName)
     print(plateid)
-    data = self.platemeta[plateid]
-    
-    thismeta = data
+    data = blank_to_none(self.platemeta[plateid])
+    norm = self.normalized[plateid] #values derived once from the logbook
+    if norm["errors"]:
+      raise ValueError(f"Bad logbook record {plateid}: "+"; ".join(
+        f"{column}: {message}" for column, message in norm["errors"].items()))
 
     objtype = data["OBJTYPE"] #we will add the column with data later
-    try:
-      for k,v in data.items():
-        if isinstance(v, str) and (v == " " or v == "  " or v == ""):
-          data[k] = None
-    except AttributeError:
-      print("AttributeError data")
-
 
     #if some columns are renamed it is easier to fix it here
     #and in the end when we are saving table
@@ -1570,87 +3356,35 @@ class PAHeaderAdder(api.AnetHeaderProcessor):
     skycond   = data["SKYCOND_en"]
 
     #~~~~~~~~~~~~~~~~~~~COORDINATES~~~~~~~~~~~~~~~~~~~~~~
-    #~~~~~~~~~SIMBAD-QUERY~~~~~~~~~
-    ra_simbad = []
-    dec_simbad = []
-    for obj in obj_name.replace(",",";").split(";"):
-      simbad_table = Simbad.query_object(obj)
-      if simbad_table:#if object data there is in Simbad
-        ra_simbad.append(":".join(simbad_table["RA"].data[0].split(" ")))
-        dec_simbad.append(":".join(simbad_table["DEC"].data[0].split(" ")))
-      else:#if not
-        ra_simbad.append(None)
-        dec_simbad.append(None)
-
-    ra_simbad = [ra_s for ra_s in ra_simbad if str(ra_s) != 'nan']
-    dec_simbad = [dec_s for dec_s in dec_simbad if str(dec_s) != 'nan']
-
-    if len(ra_simbad)==0:
-      ra_simbad = None
-      dec_simbad = None
-
-    #~~~~~~~~~COORDS EDITED~~~~~~~~~
-    if ra==ra and ra!=None:#if there is data in obs log
-      if ra=="" or ra==" " or ra=="  ":
-        ra_edit = None#there is no data in neither obs log or Simbad
-      else:
-        ra_edit = reformat_ra(ra) # hh:mm:ss
-    else:#if there is no data in obs log
-      if ra_simbad == ra_simbad:#if there is data in Simbad
-        ra_edit = ra_simbad#list of hh:mm:ss format ra
-      else:#if there is not data in Simbad
-        ra_edit = None#there is no data in neither obs log or Simbad
-    if dec == dec and dec!=None:#if there is data in obs log
-      if dec=="":
-        dec_edit = None#there is no data in neither obs log or Simbad
-      else:
-        dec_edit = reformat_dec(dec) # dd:mm:ss
-    else:#if there is no data in obs log
-      if dec_simbad == dec_simbad:#if there is data in Simbad
-        dec_edit=dec_simbad#list of hh:mm:ss format ra
-      else:#if there is not data in Simbad
-        dec_edit = None#there is no data in neither obs log or Simbad
-    if dec_edit:
-      dec_deg = dec_to_deg(dec_edit[0])
-    else:
-      decdeg = None
-    if ra_edit:
-      ra_deg = ra_to_deg(ra_edit[0])
-    else:
-      ra_deg = None
-
+    timer.start("coordinates")
+    ra_edit, ra_deg, dec_edit, dec_deg = self._getPointing(data, norm)
 
     #~~~~~~~~~~~~~~~~~~~DATE AND TIME ORIG~~~~~~~~~~~~~~~~~~~~~~
+    timer.start("times")
+    observatory = get_observatory()
 
-    tms_lt_edit  = None
-    tme_lt_edit  = None
-    tms_lst_edit = None
-    tme_lst_edit = None
-
-    if tms_lt:
-      tms_lt_edit=reformat_time(tms_lt)
-    if tme_lt:
-      tme_lt_edit=reformat_time(tme_lt)
-    if tms_lst:
-      tms_lst_edit=reformat_time(tms_lst)
-    if tme_lst:
-      tme_lst_edit=reformat_time(tme_lst)
+    tms_lt_edit  = norm["tms_lt_edit"]
+    tme_lt_edit  = norm["tme_lt_edit"]
+    tms_lst_edit = norm["tms_lst_edit"]
+    tme_lst_edit = norm["tme_lst_edit"]
 
+    # copies, as obs_times may be fixed up below
     if tms_lt_edit:
-      obs_times = tms_lt_edit
+      obs_times = list(tms_lt_edit)
+    elif tms_lst_edit:
+      obs_times = list(tms_lst_edit) #then lst
     else:
-      obs_times = tms_lst_edit #then lst or None
+      obs_times = None
 
-    if date_obs == date_obs and date_obs!=None:
-      date_obs_orig = parse_date_list(date_obs) #returns first date (12-13.02.1987 --> 12.02.1987)
-
-    else:
-      date_obs_orig = None
+    date_obs_orig = norm["date_obs_orig"] #returns first date (12-13.02.1987 --> 12.02.1987)
     #~~~~~~~~~~~~~~~~~~~DATE AND TIME EDITED (UT)~~~~~~~~~~~~~~~~~~~~~~#AttributeError, AttributeError("'list' object has no attribute 'strip'")
 
     time_format = ""
 
-    if obs_times!=None and date_obs_orig!=None:
+    if plateid in self.time_formats:
+      time_format, date_obs_edit = self.time_formats[plateid]
+
+    elif obs_times!=None and date_obs_orig!=None:
       dates_0 = date_obs_orig[0].replace(" ","").split(".") #we need only the first date
       # for i in range(0,len(dates_0)): #because somewhate there are occure spaces (?)
       #   dates_0 = dates_0.replace(" ","")
@@ -1763,20 +3497,12 @@ class PAHeaderAdder(api.AnetHeaderProcessor):
     
 
     #~~~~~~~~~~~~~~~~~~~TRANSLITERATION ~~~~~~~~~~~~~~~~~~~~~~
-    try:
-      observer_edit = translit(observer, 'ru', reversed=True)
-    except AttributeError:
-      observer_edit = None
-    try:
-      emulsion_edit = translit(emulsion, 'ru', reversed=True) #cause there some ru names
-    except AttributeError:
-      emulsion_edit = None
+    timer.start("mapping")
+    observer_edit = norm["observer_edit"]
+    emulsion_edit = norm["emulsion_edit"] #cause there some ru names
 
     #~~~~~~~~~~~~~~~~~~~DICTIONARY ~~~~~~~~~~~~~~~~~~~~~~
-    if telescope:
-      telescope_edit = TELESCOPE_ENG[telescope.lower().replace(" ","")] #####################MAY BE WE SHOULD USE UPPER CASE TO COMPAIR VALUE WITH DICTIONARY
-    else:
-      telescope_edit = None
+    telescope_edit = norm["telescope_edit"] #####################MAY BE WE SHOULD USE UPPER CASE TO COMPAIR VALUE WITH DICTIONARY
 
     if telescope_edit:
       foclen = TELESCOPE_PARAM_DIC.get(telescope_edit)[0]
@@ -1795,27 +3521,20 @@ class PAHeaderAdder(api.AnetHeaderProcessor):
       if plate_size:
         plate_size = plate_size[1]
 
-    if method:
-      method_edit = METHOD_ENG[method.lower().replace(" ","")]
-    else:
-      method_edit = None
-
-    if filters:
-      #Remove spaces, dots; replace commas and pluses with semicolon; use lower case
-      filters_edit = [FILTERS_ENG["".join(filt.split()).lower()] for filt in filters.replace(" ","").replace(".","").replace(",",";").replace("+",";").split(";")]
-    else:
-      filters_edit = None
+    method_edit = norm["method_edit"]
+    filters_edit = norm["filters_edit"]
 
     if exptime:
-      numexp=len(parse_exposure_times(exptime))
-      variable_arguments = get_exposure_cards(exptime)
+      numexp=len(norm["exptimes"])
+      variable_arguments = dict(norm["exposure_cards"])
     else:
       numexp = None
       variable_arguments = {"EXPTIME": None} 
     #~~~~~~~~~~~~~~~HEADER WITH EDITED DATA~~~~~~~~~~~~~~~~~~
+    timer.start("header")
 
     if date_obs:
-      variable_arguments.update(get_date_cards(date_obs))
+      variable_arguments.update(norm["date_cards"])
 
     if objtype:
       variable_arguments.update(get_objtype_cards(objtype))
@@ -1827,16 +3546,16 @@ class PAHeaderAdder(api.AnetHeaderProcessor):
     #  variable_arguments.update(get_object_cards(obj_name))
 
     if tms_lst:
-      variable_arguments.update(get_time_start_cards(tms_lst, time_format))
+      variable_arguments.update(get_time_start_cards(tms_lst_edit, time_format))
     elif tms_lt:
-      variable_arguments.update(get_time_start_cards(tms_lt, time_format))
+      variable_arguments.update(get_time_start_cards(tms_lt_edit, time_format))
     else:
       variable_arguments.update({"TMS-ORIG":None})
 
     if tme_lst:
-      variable_arguments.update(get_time_end_cards(tme_lst, time_format))
+      variable_arguments.update(get_time_end_cards(tme_lst_edit, time_format))
     elif tme_lt:
-      variable_arguments.update(get_time_end_cards(tme_lt, time_format))
+      variable_arguments.update(get_time_end_cards(tme_lt_edit, time_format))
     else:
       variable_arguments.update({"TME-ORIG":None})
 
@@ -1854,7 +3573,7 @@ class PAHeaderAdder(api.AnetHeaderProcessor):
     if date_obs_edit:
       if type(date_obs_edit)==list:
         date_obs_edit=date_obs_edit[0]
-      else:
+      elif not isinstance(date_obs_edit, str): #_inferTimeFormats gives strings
         date_obs_edit=date_obs_edit.fits
 
 
@@ -1897,8 +3616,10 @@ class PAHeaderAdder(api.AnetHeaderProcessor):
       FILENAME = self.fits_name.replace('.fit',''),
       **variable_arguments)
 
-    self.fits_file[0].header = new_hdr
-    self.fits_file.writeto("/var/gavo/inputs/schmidt_telescope_lc/data_astrometry_test/"+self.fits_name, output_verify="fix",overwrite=True) 
+    # only the header changes, so we don't rewrite the pixels if we can help it
+    timer.start("write")
+    write_fits_with_header(srcName,
+      os.path.join(ASTROMETRY_OUT_DIR, self.fits_name), new_hdr)
     return new_hdr
 
 if __name__=="__main__":
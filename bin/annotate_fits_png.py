@@ -28,6 +28,9 @@ from gavo.helpers import fitstricks
 from gavo import api
 from gavo.helpers import anet
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from previews import PREVIEW_STORE, get_preview_path, render_preview
+
 
 ##################################################
 #_______________SOME INITIAL DATA________________#
@@ -1473,6 +1476,10 @@ class PAHeaderAdder(api.AnetHeaderProcessor):
     api.AnetHeaderProcessor.addOptions(optParser)
     optParser.add_option("--test", help="Run unit tests, then exit",
       action="callback", callback=run_tests)
+    optParser.add_option("--render-previews", help="Render a preview of"
+      f" each plate to {PREVIEW_STORE} while importing (it is faster to"
+      " run make_previews.py afterwards)", action="store_true",
+      dest="renderPreviews", default=False)
 
   def _createAuxiliaries(self, dd):
     log_path = os.path.join(dd.rd.resdir, "/var/gavo/inputs/logbook_archival", "logbook.csv")
@@ -1896,32 +1903,11 @@ class PAHeaderAdder(api.AnetHeaderProcessor):
       SKYCOND = skycond,
       FILENAME = self.fits_name.replace('.fit',''),
       **variable_arguments)
-    def save_visualization(srcName, ra_deg, dec_deg):
-        hdu_list = fits.open(srcName)
-        wcs = WCS(hdu_list[0].header)
-        data = hdu_list[0].data
-
-        fig = plt.figure()  
-        ax = fig.add_subplot(111, projection=wcs)
-        interval = ZScaleInterval()
-        vmin, vmax = interval.get_limits(data)
-        norm = ImageNormalize(vmin=vmin, vmax=vmax)
-        ax.imshow(data, origin='lower', cmap='gray', norm=norm)
-
-        if ra_deg is not None and dec_deg is not None:
-            ax.scatter([ra_deg], [dec_deg], transform=ax.get_transform('world'), s=100, edgecolor='red', facecolor='none')
-
-        plt.xlabel('RA')
-        plt.ylabel('Dec')
-        plt.grid(color='white', ls='dotted')
-        plt.colorbar(ax.imshow(data, origin='lower', cmap='gray', norm=norm))
-        plt.title(f'{srcName}')
-
-        output_path = f'{srcName}_visualization.png'
-        plt.savefig(output_path)
-        print(f'Saved visualization to {output_path}')
-
-    save_visualization(srcName, ra_deg, dec_deg)
+    if self.opts.renderPreviews:
+      output_path = get_preview_path(srcName)
+      os.makedirs(PREVIEW_STORE, exist_ok=True)
+      render_preview(srcName, output_path, ra_deg, dec_deg)
+      print(f'Saved visualization to {output_path}')
 
     self.fits_file[0].header = new_hdr
     self.fits_file.writeto("/var/gavo/inputs/schmidt_telescope_lc/data_astrometry_test/"+self.fits_name, output_verify="fix",overwrite=True) 
@@ -0,0 +1,321 @@
+"""
+benchmarks for the logbook parsing and time conversion functions in
+annotate_fits.py and for _mungeHeader as a whole.
+
+The inputs come from a synthetic logbook built from the value formats in
+annotate_fits' doctests, so runs are reproducible (given --seed) and do
+not need the real logbook or plates.  Results are printed and, with
+--json, written for comparison with later runs:
+
+  python3 bench_annotate_fits.py --json bench-before.json
+  ... change things ...
+  python3 bench_annotate_fits.py --json bench-after.json --compare bench-before.json
+
+Function benchmarks report calls per second (best of --repeat runs);
+the _mungeHeader benchmark reports per-plate latency percentiles and
+the time spent in its stages.
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import annotate_fits as af
+
+from astropy.io import fits
+from astropy.time import Time
+import numpy as np
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~SYNTHETIC LOGBOOK~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# the formats from the doctests that annotate_fits understands
+RA_VARIANTS = ["05 32 49", "05h33m", "02h41m45s", "01 28"]
+DEC_VARIANTS = ["29.06", "-23.30", "50 41 45", "-01 28 02", "-01 28"]
+EXPTIME_VARIANTS = ["1h", "4h30m", "1h30m20s", "20m", "10.5m", "1m10s",
+  "15s", "20m;15m"]
+TIME_VARIANTS = ["12.h5", "2h23m23s", "5h31", "5h31m", "13h54m24s",
+  "13h54m24"]
+# rows with two dates get two start and end times, as in the logbook
+DATE_VARIANTS = ["13.03.1956", "13.04.76", "01-02.01.1964", "01-02.01.64",
+  "31.08-01.09.1967", "31.08-01.09.67", "31.12.1965-01.01.1966",
+  "31.12.65-01.01.66", "31.12.65-01.01.1966", "31.12.1965-01.01.66",
+  "13.03.1956;14.03.1956", "01-02.01.1964;02-03.01.1964"]
+TELESCOPE_VARIANTS = ["Большой Шмидт", "Малый Шмидт",
+  "50 cm менисковый телескоп Максутова", "AZT-8"]
+OBSERVER_VARIANTS = ["Иванов", "Петрова", "Kharitonov"]
+EMULSION_VARIANTS = ["ORWO ZU-21", "Кодак 103а-О", "A-600"]
+FILTER_VARIANTS = ["бф", "ЖС18", "жс12+бс8", None]
+OBJECT_VARIANTS = ["M44", "NGC6611;NGC6618", "Comet Halley", None]
+
+LOGBOOK_COLUMNS = ["ID", "OBJECT", "OBJTYPE", "RA", "DEC", "DATE-OBS",
+  "EXPTIME", "TMS-LST", "TME-LST", "TMS-LT", "TME-LT", "TELESCOPE",
+  "OBSERVER", "EMULSION", "METHOD", "SIZE", "FILTER", "FOCUS",
+  "PLATNOTE_en", "SCANNOTE_en", "OBSNOTE_en", "NOTES_en", "SKYCOND_en"]
+
+def make_logbook_rows(n_plates, seed=0):
+  """
+  returns n_plates synthetic logbook records (dicts with LOGBOOK_COLUMNS
+  keys) cycling through the formats the parsers support.
+
+  Half the records give local times, the other half sidereal times;
+  there are as many start and end times as there are dates.
+  """
+  rnd = random.Random(seed)
+  rows = []
+  for index in range(n_plates):
+    row = dict.fromkeys(LOGBOOK_COLUMNS, "")
+    date_obs = rnd.choice(DATE_VARIANTS)
+    n_dates = len(date_obs.split(";"))
+    time_columns = ("TMS-LT", "TME-LT") if index%2 else ("TMS-LST", "TME-LST")
+    row.update({
+      "ID": f"{index+1}c",
+      "OBJECT": rnd.choice(OBJECT_VARIANTS) or "",
+      "RA": rnd.choice(RA_VARIANTS),
+      "DEC": rnd.choice(DEC_VARIANTS),
+      "DATE-OBS": date_obs,
+      "EXPTIME": rnd.choice(EXPTIME_VARIANTS),
+      time_columns[0]: ";".join(rnd.sample(TIME_VARIANTS, n_dates)),
+      time_columns[1]: ";".join(rnd.sample(TIME_VARIANTS, n_dates)),
+      "TELESCOPE": rnd.choice(TELESCOPE_VARIANTS),
+      "OBSERVER": rnd.choice(OBSERVER_VARIANTS),
+      "EMULSION": rnd.choice(EMULSION_VARIANTS),
+      "METHOD": "Метод Меткофа",
+      "SIZE": "9*12",
+      "FILTER": rnd.choice(FILTER_VARIANTS) or "",
+      "FOCUS": str(rnd.randint(100, 200)),
+      "SKYCOND_en": "clear",
+    })
+    rows.append(row)
+  return rows
+
+def make_logbook_csv(rows):
+  """
+  returns rows as CSV text in the logbook's format.
+  """
+  f = io.StringIO(newline="")
+  writer = csv.DictWriter(f, LOGBOOK_COLUMNS)
+  writer.writeheader()
+  writer.writerows(rows)
+  return f.getvalue()
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~TIMING~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def calls_per_second(func, args_list, repeat=5, min_time=0.2):
+  """
+  returns the best throughput (calls per second) of func over args_list
+  in repeat runs, each calling func on all of args_list at least once
+  and for at least min_time seconds.
+  """
+  best = 0
+  for _ in range(repeat):
+    n_calls, started = 0, time.perf_counter()
+    while True:
+      for args in args_list:
+        func(*args)
+      n_calls += len(args_list)
+      elapsed = time.perf_counter()-started
+      if elapsed>=min_time:
+        break
+    best = max(best, n_calls/elapsed)
+  return best
+
+def get_function_benchmarks(rows):
+  """
+  returns a list of (name, function, argument tuples) for the functions
+  we benchmark, with arguments taken from the synthetic logbook rows.
+  """
+  # (dates, times) per row, for the rows with sidereal and local times
+  sid_args, local_args = [], []
+  for row in rows:
+    dates = af.parse_date_list(row["DATE-OBS"])
+    if row["TMS-LST"]:
+      sid_args.append((dates, af.reformat_time(row["TMS-LST"])))
+    else:
+      local_args.append((dates, af.reformat_time(row["TMS-LT"])))
+  # a few hundred Time objects are plenty, and making them is slow
+  n_times = min(len(rows), 200)
+  observatory = af.get_observatory()
+  obs_times = [Time(f"19{50+index%50}-{1+index%12:02d}-15 21:30:00")
+    for index in range(n_times)]
+
+  return [
+    ("ra_to_deg", af.ra_to_deg, [(row["RA"],) for row in rows]),
+    ("dec_to_deg", af.dec_to_deg, [(row["DEC"],) for row in rows]),
+    ("parse_single_exposure", af.parse_single_exposure,
+      [(exp,) for row in rows for exp in row["EXPTIME"].split(";")]),
+    ("reformat_single_time", af.reformat_single_time,
+      [(row[col],) for row in rows for col in ["TMS-LT", "TMS-LST"]
+        if row[col]]),
+    ("parse_date_list", af.parse_date_list,
+      [(row["DATE-OBS"],) for row in rows]),
+    ("get_sid_delta", af.get_sid_delta, sid_args[:n_times]),
+    ("get_lt_from_st", af.get_lt_from_st, sid_args[:n_times]),
+    ("convert_local_date_time_UT", af.convert_local_date_time_UT,
+      local_args[:n_times]),
+    ("sun_set_rise_time", af.sun_set_rise_time,
+      [(t, observatory) for t in obs_times]),
+    ("get_delta_real", af.get_delta_real, [(t,) for t in obs_times]),
+  ]
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~MUNGEHEADER~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def make_processor(rows, work_dir):
+  """
+  returns a PAHeaderAdder set up like _createAuxiliaries would for the
+  synthetic logbook rows, but without DaCHS, the network or the real
+  cache directory.
+  """
+  proc = af.PAHeaderAdder.__new__(af.PAHeaderAdder)
+  proc.opts = types.SimpleNamespace(reProcess=True, simbadOffline=True,
+    ignoreSolveCache=True, extractionBinning=1, workers=1)
+  proc.fits_name = proc.src_name = proc.n_extracted = None
+  proc.run_id = "bench"
+  proc.platemeta = af.LogbookStore.fromCSV(
+    io.StringIO(make_logbook_csv(rows), newline=""))
+  proc.normalized = af.normalize_logbook(proc.platemeta)
+  proc.simbad = af.SimbadCache(":memory:", offline=True)
+  af.TIME_FORMATS_CACHE_PATH = os.path.join(work_dir, "time-formats.pickle")
+  proc.time_formats = proc._inferTimeFormats()
+  proc.ledger = af.JobLedger(os.path.join(work_dir, "ledger.jsonl"))
+  return proc
+
+def make_plates(rows, plate_dir, shape=(64, 64)):
+  """
+  writes a small FITS file named like our scans for each logbook row
+  to plate_dir and returns their paths.
+  """
+  data = np.zeros(shape, dtype=np.int16)
+  paths = []
+  for row in rows:
+    path = os.path.join(plate_dir, f"fai50_{row['ID']}.fit")
+    fits.PrimaryHDU(data).writeto(path, overwrite=True)
+    paths.append(path)
+  return paths
+
+def time_munge_header(rows, work_dir):
+  """
+  returns a dict with latency statistics (in milliseconds) of
+  _mungeHeader over one synthetic plate per logbook row.
+
+  Records _mungeHeader rejects are counted as failures and not timed.
+  """
+  plate_dir = os.path.join(work_dir, "plates")
+  out_dir = os.path.join(work_dir, "out")
+  os.makedirs(plate_dir)
+  os.makedirs(out_dir)
+  proc = make_processor(rows, work_dir)
+  af.ASTROMETRY_OUT_DIR = out_dir
+  af.TIMING_LOG_PATH = os.path.join(work_dir, "munge-timings.jsonl")
+
+  latencies, failures = [], 0
+  for path in make_plates(rows, plate_dir):
+    hdr = proc.getPrimaryHeader(path)
+    started = time.perf_counter()
+    try:
+      proc._mungeHeader(path, hdr)
+    except Exception:
+      failures += 1
+      continue
+    latencies.append(time.perf_counter()-started)
+
+  latencies = np.array(latencies)*1000
+  if not len(latencies):
+    return {"plates": 0, "failures": failures}
+  return {
+    "plates": len(latencies),
+    "failures": failures,
+    "median_ms": float(np.median(latencies)),
+    "p90_ms": float(np.percentile(latencies, 90)),
+    "max_ms": float(latencies.max()),
+    "plates_per_s": float(len(latencies)/latencies.sum()*1000),
+    "stages": af.summarize_timings(proc.run_id, af.TIMING_LOG_PATH),
+  }
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~MAIN~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def run_benchmarks(n_plates, seed, repeat, selected=None):
+  rows = make_logbook_rows(n_plates, seed)
+  results = {"plates": n_plates, "seed": seed, "functions": {}}
+  for name, func, args_list in get_function_benchmarks(rows):
+    if selected and name not in selected:
+      continue
+    try:
+      results["functions"][name] = calls_per_second(func, args_list, repeat)
+    except Exception as ex:
+      # the inputs are supposed to be valid, so this is a bug somewhere;
+      # report it and go on with the other benchmarks
+      print(f"{name:30s} FAILED: {ex.__class__.__name__}: {ex}")
+      continue
+    print(f"{name:30s} {results['functions'][name]:12.1f} calls/s")
+
+  if not selected or "_mungeHeader" in selected:
+    with tempfile.TemporaryDirectory() as work_dir:
+      results["_mungeHeader"] = time_munge_header(rows, work_dir)
+    print("_mungeHeader", " ".join(f"{key}={value:.4g}"
+      for key, value in results["_mungeHeader"].items() if key!="stages"))
+    af.print_timing_summary(results["_mungeHeader"].get("stages"))
+  return results
+
+def compare(results, baseline):
+  """
+  prints the changes in throughput between baseline and results.
+  """
+  print("\nchange against baseline (positive is faster):")
+  for name, rate in results["functions"].items():
+    old_rate = baseline.get("functions", {}).get(name)
+    if old_rate:
+      print(f"{name:30s} {(rate/old_rate-1)*100:+8.1f}%")
+  old_munge = baseline.get("_mungeHeader", {}).get("median_ms")
+  new_munge = results.get("_mungeHeader", {}).get("median_ms")
+  if old_munge and new_munge:
+    print(f"{'_mungeHeader (median)':30s} {(old_munge/new_munge-1)*100:+8.1f}%")
+
+def parse_command_line():
+  parser = argparse.ArgumentParser(description=
+    "Benchmark the logbook parsing in annotate_fits.py.")
+  parser.add_argument("-n", "--plates", type=int, default=500,
+    help="Number of synthetic logbook records (default %(default)s)")
+  parser.add_argument("--seed", type=int, default=0,
+    help="Seed for the synthetic logbook (default %(default)s)")
+  parser.add_argument("--repeat", type=int, default=5,
+    help="Runs per function; the best counts (default %(default)s)")
+  parser.add_argument("--only", action="append", metavar="NAME",
+    help="Only run this benchmark (may be given more than once)")
+  parser.add_argument("--json", metavar="FILE",
+    help="Write the results to FILE")
+  parser.add_argument("--compare", metavar="FILE",
+    help="Compare with results written by an earlier --json")
+  return parser.parse_args()
+
+def main():
+  args = parse_command_line()
+  results = run_benchmarks(args.plates, args.seed, args.repeat, args.only)
+  if args.json:
+    with open(args.json, "w") as f:
+      json.dump(results, f, indent=2)
+  if args.compare:
+    with open(args.compare) as f:
+      compare(results, json.load(f))
+
+if __name__=="__main__":
+  main()
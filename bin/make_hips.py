@@ -0,0 +1,169 @@
+"""
+builds and extends a HiPS of the astrometrically calibrated Schmidt
+plates, so the whole archive can be browsed in Aladin.
+
+This selects the plates in the astrometry output directory that have
+been solved (i.e., have A_ORDER from PAHeaderAdder's anet run) and that
+are not yet in the HiPS, and hands them to CDS' Hipsgen.  The first run
+builds the HiPS; later runs use Hipsgen's APPEND action to add just the
+new plates.  Hipsgen does the reprojection into HEALPix tiles over all
+orders, in parallel (--threads), within the Java heap given by --memory,
+reading one plate at a time.
+
+What is in the HiPS is remembered in the store (PLATES_NAME).  Plates
+that changed after they went into the HiPS are reported, but cannot be
+replaced by APPEND; rebuild with --rebuild to get rid of the old
+versions.
+
+  python3 make_hips.py
+  python3 make_hips.py --rebuild --threads 32
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from plate_io import ASTROMETRY_OUT_DIR, plate_file_name, replacing
+
+from astropy.io import fits
+
+
+HIPS_STORE = os.path.normpath(os.path.join(
+  os.path.dirname(os.path.abspath(__file__)), os.pardir, "hips"))
+HIPSGEN_JAR = os.environ.get("HIPSGEN_JAR", "/usr/local/share/Hipsgen.jar")
+HIPS_ID = "FAI/P/SchmidtLC"
+HIPS_TITLE = "FAI Schmidt telescope (large camera) plates"
+# plate file name -> fingerprint of the plates in the HiPS
+PLATES_NAME = "plates.json"
+
+def fingerprint(src_name):
+  st = os.stat(src_name)
+  return f"{st.st_size}:{st.st_mtime_ns}"
+
+def is_solved(src_name):
+  """
+  returns True if the plate src_name has a SIP solution from anet.
+  """
+  return "A_ORDER" in fits.getheader(src_name)
+
+def read_plates(store):
+  try:
+    with open(os.path.join(store, PLATES_NAME), encoding="utf-8") as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return {}
+
+def write_plates(store, plates):
+  with replacing(os.path.join(store, PLATES_NAME)) as tmp_name:
+    with open(tmp_name, "w", encoding="utf-8") as f:
+      json.dump(plates, f, indent=1, sort_keys=True)
+
+def select_plates(src_dir, in_hips):
+  """
+  returns a pair of lists (new, changed) of the solved plates in src_dir
+  that are not in the HiPS yet or have changed since they went in,
+  according to in_hips (as read by read_plates).
+
+  Plates already in the HiPS are not opened.
+  """
+  new, changed = [], []
+  for name in sorted(os.listdir(src_dir)):
+    if not name.endswith(".fit"):
+      continue
+    src_name = os.path.join(src_dir, name)
+    known = in_hips.get(plate_file_name(src_name))
+    if known==fingerprint(src_name):
+      continue
+    if not is_solved(src_name):
+      continue
+    (new if known is None else changed).append(src_name)
+  return new, changed
+
+def run_hipsgen(in_dir, store, actions, threads, memory, order=None):
+  """
+  runs Hipsgen on the plates in in_dir, writing to store.
+  """
+  cmd = ["java", f"-Xmx{memory}", "-jar", HIPSGEN_JAR,
+    f"in={in_dir}", f"out={store}", f"id={HIPS_ID}",
+    f"title={HIPS_TITLE}", "hdu=0", f"maxThread={threads}"]
+  if order is not None:
+    cmd.append(f"order={order}")
+  cmd.extend(actions)
+  print(" ".join(cmd))
+  subprocess.run(cmd, check=True)
+
+def make_hips(src_dir=ASTROMETRY_OUT_DIR, store=HIPS_STORE, threads=None,
+    memory="4g", order=None, rebuild=False):
+  """
+  puts the solved plates in src_dir into the HiPS in store and returns
+  the number of plates added.
+  """
+  threads = threads or os.cpu_count()
+  os.makedirs(store, exist_ok=True)
+  in_hips = {} if rebuild else read_plates(store)
+  new, changed = select_plates(src_dir, in_hips)
+  for src_name in changed:
+    print(f"{src_name} changed since it went into the HiPS; run with"
+      " --rebuild to replace it")
+  if not new:
+    print("No new solved plates")
+    return 0
+
+  # Hipsgen takes a directory; we give it one with links to the new plates
+  stage_dir = tempfile.mkdtemp(dir=os.path.dirname(store),
+    prefix=".hips-staging-")
+  try:
+    for src_name in new:
+      os.symlink(os.path.abspath(src_name),
+        os.path.join(stage_dir, plate_file_name(src_name)))
+    if in_hips:
+      run_hipsgen(stage_dir, store, ["APPEND"], threads, memory, order)
+    else:
+      # a fresh build: throw away what's there and let Hipsgen do all
+      # its default steps
+      for name in os.listdir(store):
+        path = os.path.join(store, name)
+        if os.path.isdir(path):
+          shutil.rmtree(path)
+        else:
+          os.unlink(path)
+      run_hipsgen(stage_dir, store, [], threads, memory, order)
+  finally:
+    shutil.rmtree(stage_dir, ignore_errors=True)
+
+  for src_name in new:
+    in_hips[plate_file_name(src_name)] = fingerprint(src_name)
+  write_plates(store, in_hips)
+  print(f"{len(new)} plates added to the HiPS")
+  return len(new)
+
+def parse_command_line():
+  parser = argparse.ArgumentParser(description="Build or extend the HiPS"
+    " of the solved Schmidt plates.")
+  parser.add_argument("--src-dir", default=ASTROMETRY_OUT_DIR,
+    help="Directory with the annotated plates (default %(default)s)")
+  parser.add_argument("--store", default=HIPS_STORE,
+    help="HiPS directory (default %(default)s)")
+  parser.add_argument("--threads", type=int, default=None,
+    help="Hipsgen threads (default: one per CPU)")
+  parser.add_argument("--memory", default="4g",
+    help="Java heap for Hipsgen (default %(default)s)")
+  parser.add_argument("--order", type=int, default=None,
+    help="Deepest HiPS order (default: Hipsgen's choice from the"
+      " plates' resolution)")
+  parser.add_argument("--rebuild", action="store_true",
+    help="Build the HiPS from scratch")
+  return parser.parse_args()
+
+def main():
+  args = parse_command_line()
+  make_hips(args.src_dir, args.store, args.threads, args.memory,
+    args.order, args.rebuild)
+
+if __name__=="__main__":
+  main()
@@ -0,0 +1,189 @@
+"""
+renders PNG previews of Schmidt plates into the preview store.
+
+Previews used to be made while importing (annotate_fits_png.py), one
+after the other, and redone on every run.  This renders them in a pool
+of processes instead, and only for plates that are new or changed:
+a preview is kept if it is newer than its plate and the plate's header
+(which, e.g., gets the WCS after astrometric calibration) is the one
+it was made from.
+
+  python3 make_previews.py /var/gavo/inputs/astroplates/schmidt_telescope_lc/header_done
+  python3 make_previews.py --from-table
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from plate_io import read_header_bytes, replacing
+from previews import (PREVIEW_SIZE, PREVIEW_STORE,
+  get_preview_path, render_preview)
+
+from astropy.io import fits
+
+
+# what we know about the previews in a store: plate file name ->
+# {"source": plate path, "header": header_digest of the plate}
+INDEX_NAME = "index.json"
+
+def header_digest(src_name):
+  """
+  returns a sha1 of the primary header of the FITS file src_name, reading
+  nothing but the header blocks.
+  """
+  with open(src_name, "rb") as f:
+    return hashlib.sha1(read_header_bytes(f)).hexdigest()
+
+def read_index(store):
+  try:
+    with open(os.path.join(store, INDEX_NAME), encoding="utf-8") as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return {}
+
+def write_index(store, index):
+  """
+  atomically replaces the index of store with index.
+  """
+  with replacing(os.path.join(store, INDEX_NAME)) as tmp_name:
+    with open(tmp_name, "w", encoding="utf-8") as f:
+      json.dump(index, f, indent=1, sort_keys=True)
+
+def is_up_to_date(src_name, store, index):
+  """
+  returns True if the preview of src_name in store is newer than
+  src_name and was made from a plate with the same header.
+  """
+  preview = get_preview_path(src_name, store)
+  try:
+    if os.path.getmtime(preview)<os.path.getmtime(src_name):
+      return False
+  except OSError:
+    return False
+  entry = index.get(os.path.basename(preview))
+  return entry is not None and entry["header"]==header_digest(src_name)
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~SOURCES~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def iter_directory_plates(dirs):
+  for dir in dirs:
+    yield from sorted(glob.glob(os.path.join(dir, "*.fit")))
+
+def iter_table_plates(table="schmidt_telescope_lc.main"):
+  """
+  iterates over the paths of the plates in the DaCHS table table.
+  """
+  from gavo import api
+  inputs_dir = api.getConfig("inputsDir")
+  with api.getTableConn() as conn:
+    for access_path, in conn.query("SELECT p.accessPath"
+        f" FROM {table} AS m JOIN dc.products AS p ON (m.accref=p.accref)"
+        " ORDER BY p.accessPath"):
+      yield os.path.join(inputs_dir, access_path)
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~RENDERING~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def render_one(args):
+  """
+  renders the preview for a plate in a pool worker.
+
+  args is (src_name, store, size).  This returns a tuple (src_name,
+  header digest or None, error message or None, seconds spent).
+  """
+  src_name, store, size = args
+  started = time.time()
+  try:
+    # the digest is taken before rendering; if the header changes while
+    # we render, the next run will notice.
+    digest = header_digest(src_name)
+    header = fits.getheader(src_name)
+    with replacing(get_preview_path(src_name, store), suffix=".png"
+        ) as tmp_name:
+      render_preview(src_name, tmp_name,
+        header.get("RA_DEG"), header.get("DEC_DEG"), max_size=size)
+    return src_name, digest, None, time.time()-started
+  except Exception as ex:
+    return src_name, None, f"{ex.__class__.__name__}: {ex}", time.time()-started
+
+def make_previews(src_names, store=PREVIEW_STORE, workers=None,
+    size=PREVIEW_SIZE, force=False):
+  """
+  renders previews for those of src_names whose previews in store are
+  missing or out of date, using workers processes.
+
+  This returns the number of previews rendered and the number of
+  failures.
+  """
+  os.makedirs(store, exist_ok=True)
+  index = read_index(store)
+  todo = [src_name for src_name in src_names
+    if force or not is_up_to_date(src_name, store, index)]
+  print(f"{len(todo)} previews to render")
+
+  n_done, n_failed, started = 0, 0, time.time()
+  try:
+    with multiprocessing.Pool(workers) as pool:
+      for src_name, digest, error, seconds in pool.imap_unordered(
+          render_one, [(src_name, store, size) for src_name in todo]):
+        if error:
+          n_failed += 1
+          print(f"FAILED {src_name}: {error}")
+          continue
+        n_done += 1
+        index[os.path.basename(get_preview_path(src_name, store))] = {
+          "source": src_name, "header": digest}
+        if n_done%100==0:
+          print(f"{n_done}/{len(todo)} previews after"
+            f" {time.time()-started:.0f} s")
+  finally:
+    # keep what we have even if interrupted
+    write_index(store, index)
+
+  print(f"{n_done} previews rendered in {time.time()-started:.0f} s,"
+    f" {n_failed} failed")
+  return n_done, n_failed
+
+def parse_command_line():
+  parser = argparse.ArgumentParser(description="Render previews of"
+    " Schmidt plates into the preview store.")
+  parser.add_argument("dirs", nargs="*", metavar="DIR",
+    help="Directories with plates (*.fit) to make previews for")
+  parser.add_argument("--from-table", action="store_true",
+    help="Make previews for all plates in schmidt_telescope_lc.main")
+  parser.add_argument("--store", default=PREVIEW_STORE,
+    help="Directory to write previews to (default %(default)s)")
+  parser.add_argument("--workers", type=int, default=None,
+    help="Number of rendering processes (default: one per CPU)")
+  parser.add_argument("--size", type=int, default=PREVIEW_SIZE,
+    help="Longest side of the previews in pixels (default %(default)s)")
+  parser.add_argument("--force", action="store_true",
+    help="Render previews even if they are up to date")
+  args = parser.parse_args()
+  if not args.dirs and not args.from_table:
+    parser.error("Give directories or --from-table")
+  return args
+
+def main():
+  args = parse_command_line()
+  src_names = list(iter_directory_plates(args.dirs))
+  if args.from_table:
+    src_names.extend(iter_table_plates())
+  n_done, n_failed = make_previews(src_names, args.store, args.workers,
+    args.size, args.force)
+  sys.exit(1 if n_failed else 0)
+
+if __name__=="__main__":
+  main()
@@ -0,0 +1,278 @@
+"""
+builds deep zoom tile pyramids of Schmidt plates for panning and zooming
+in the browser.
+
+For each plate, this writes NAME.dzi and NAME_files/LEVEL/COL_ROW.png
+(the Deep Zoom layout that OpenSeadragon and friends read), plus
+NAME.html, a page showing the pyramid in OpenSeadragon, into the tile
+store, which the tiles service in q.rd serves statically.  The import
+notes which plates have a pyramid, so run this before importing the
+plates (or re-import after tiling with --from-table).  Level
+LEVEL has 2**LEVEL pixels on its longest side (rounded up); the largest
+level is the plate at full resolution.
+
+The plate is memory-mapped and read a band of tiles at a time.  The
+full resolution level is written from these bands directly, while their
+2x2 means, scaled to 8 bit, make up the next level, which is small
+enough to keep in memory; all further levels are 2x2 means of the
+previous one.
+
+  python3 make_tiles.py /var/gavo/inputs/astroplates/schmidt_telescope_lc/header_done
+  python3 make_tiles.py --from-table
+"""
+
+import argparse
+import math
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from make_previews import iter_directory_plates, iter_table_plates
+from plate_io import block_reduce, open_plate
+
+import numpy as np
+
+
+TILE_STORE = os.path.normpath(os.path.join(
+  os.path.dirname(os.path.abspath(__file__)), os.pardir, "tiles"))
+TILE_SIZE = 256
+# we estimate the zscale limits from about this many pixels
+ZSCALE_SAMPLE = 1000*1000
+
+DZI_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008"
+  TileSize="{tile_size}" Overlap="0" Format="png">
+  <Size Width="{width}" Height="{height}"/>
+</Image>
+"""
+
+OPENSEADRAGON_URL = "https://cdn.jsdelivr.net/npm/openseadragon@4.1/build/openseadragon"
+VIEWER_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{name}</title>
+<script src="{openseadragon}/openseadragon.min.js"></script>
+<style>html, body, #viewer {{width: 100%; height: 100%; margin: 0}}</style>
+</head>
+<body>
+<div id="viewer"></div>
+<script>
+OpenSeadragon({{id: "viewer", prefixUrl: "{openseadragon}/images/",
+  tileSources: "{name}.dzi"}});
+</script>
+</body>
+</html>
+"""
+
+def get_tile_name(src_name):
+  """
+  returns the name of the pyramid for the plate src_name.
+
+  >>> get_tile_name("/data/header_done/fai50_1964–07–17.fit")
+  'fai50_1964-07-17'
+  """
+  return os.path.splitext(os.path.basename(src_name).replace("–","-"))[0]
+
+def get_max_level(width, height):
+  """
+  returns the deep zoom level at which an image of width x height is
+  shown at full resolution.
+
+  >>> get_max_level(1, 1), get_max_level(256, 100), get_max_level(14000, 12000)
+  (0, 8, 14)
+  """
+  return math.ceil(math.log2(max(width, height)))
+
+def reduce2(arr):
+  """
+  returns the uint8 image arr averaged over 2x2 blocks; odd rows and
+  columns are averaged with a copy of the last row or column.
+
+  >>> reduce2(np.array([[0, 2, 10], [2, 4, 20], [6, 6, 30]], dtype=np.uint8)).tolist()
+  [[2, 15], [6, 30]]
+  """
+  return np.round(block_reduce(arr, 2, pad=True)).astype(np.uint8)
+
+def to_uint8(data, vmin, vmax):
+  """
+  returns data linearly scaled from vmin..vmax to 0..255.
+  """
+  scaled = (np.asarray(data, dtype=np.float32)-vmin)*(255/((vmax-vmin) or 1))
+  return np.clip(scaled, 0, 255).astype(np.uint8)
+
+def get_zscale_limits(data):
+  """
+  returns zscale limits for the 2D array data, estimated from a regular
+  subsample of about ZSCALE_SAMPLE pixels.
+  """
+  from astropy.visualization import ZScaleInterval
+  step = max(1, int(math.sqrt(data.shape[0]*data.shape[1]/ZSCALE_SAMPLE)))
+  return ZScaleInterval().get_limits(data[::step, ::step])
+
+def write_tiles(arr, level_dir, tile_size=TILE_SIZE, first_row=0):
+  """
+  writes arr (uint8, top row first) as tiles to level_dir.
+
+  first_row is the tile row arr starts with; arr must start at a tile
+  boundary.
+  """
+  from PIL import Image
+  os.makedirs(level_dir, exist_ok=True)
+  for row_offset in range(0, arr.shape[0], tile_size):
+    for col_offset in range(0, arr.shape[1], tile_size):
+      Image.fromarray(np.ascontiguousarray(
+          arr[row_offset:row_offset+tile_size, col_offset:col_offset+tile_size])
+        ).save(os.path.join(level_dir, "{}_{}.png".format(
+          col_offset//tile_size, first_row+row_offset//tile_size)))
+
+def build_pyramid(src_name, dest_dir, name, tile_size=TILE_SIZE):
+  """
+  writes the deep zoom pyramid for the plate src_name as name.dzi and
+  name_files to dest_dir.
+  """
+  files_dir = os.path.join(dest_dir, name+"_files")
+  with open_plate(src_name) as (header, data, scale):
+    height, width = data.shape
+    max_level = get_max_level(width, height)
+    vmin, vmax = scale(get_zscale_limits(data))
+
+    # the next-to-largest level, filled band by band
+    half = np.empty(((height+1)//2, (width+1)//2), dtype=np.uint8)
+    for top in range(0, height, tile_size):
+      # FITS images start at the bottom, tiles at the top
+      stop = height-top
+      band = to_uint8(scale(data[max(0, stop-tile_size):stop][::-1]),
+        vmin, vmax)
+      write_tiles(band, os.path.join(files_dir, str(max_level)),
+        tile_size, top//tile_size)
+      half[top//2:top//2+(band.shape[0]+1)//2] = reduce2(band)
+
+  level, arr = max_level-1, half
+  while level>=0:
+    write_tiles(arr, os.path.join(files_dir, str(level)), tile_size)
+    level, arr = level-1, reduce2(arr)
+
+  with open(os.path.join(dest_dir, name+".dzi"), "w") as f:
+    f.write(DZI_TEMPLATE.format(tile_size=tile_size, width=width,
+      height=height))
+
+def write_viewer(dest_dir, name):
+  """
+  writes name.html, a page showing the pyramid name.dzi next to it, to
+  dest_dir.
+
+  >>> tmpdir = tempfile.mkdtemp()
+  >>> write_viewer(tmpdir, "fai50_1964-07-17")
+  >>> with open(os.path.join(tmpdir, "fai50_1964-07-17.html")) as f:
+  ...   'tileSources: "fai50_1964-07-17.dzi"' in f.read()
+  True
+  """
+  with open(os.path.join(dest_dir, name+".html"), "w") as f:
+    f.write(VIEWER_TEMPLATE.format(name=name,
+      openseadragon=OPENSEADRAGON_URL))
+
+def is_up_to_date(src_name, store):
+  dzi = os.path.join(store, get_tile_name(src_name)+".dzi")
+  try:
+    return os.path.getmtime(dzi)>=os.path.getmtime(src_name)
+  except OSError:
+    return False
+
+def tile_one(args):
+  """
+  builds the pyramid for one plate in a pool worker.
+
+  args is (src_name, store).  The pyramid is built in a temporary
+  directory in store and then moved into place, so the tiles service
+  never sees half a pyramid.  This returns (src_name, error message or
+  None, seconds spent).
+  """
+  src_name, store = args
+  started = time.time()
+  name = get_tile_name(src_name)
+  tmp_dir = tempfile.mkdtemp(dir=store, prefix=".tiling-")
+  try:
+    build_pyramid(src_name, tmp_dir, name)
+    write_viewer(tmp_dir, name)
+    # old pyramid out, new one in; the .dzi goes last, as that's what
+    # is_up_to_date looks at
+    os.replace(os.path.join(tmp_dir, name+".html"),
+      os.path.join(store, name+".html"))
+    shutil.rmtree(os.path.join(store, name+"_files"), ignore_errors=True)
+    os.replace(os.path.join(tmp_dir, name+"_files"),
+      os.path.join(store, name+"_files"))
+    os.replace(os.path.join(tmp_dir, name+".dzi"),
+      os.path.join(store, name+".dzi"))
+    return src_name, None, time.time()-started
+  except Exception as ex:
+    return src_name, f"{ex.__class__.__name__}: {ex}", time.time()-started
+  finally:
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def make_tiles(src_names, store=TILE_STORE, workers=None, force=False):
+  """
+  builds pyramids for those of src_names that do not have an up-to-date
+  one in store, using workers processes.
+
+  This returns the number of pyramids built and the number of failures.
+  """
+  os.makedirs(store, exist_ok=True)
+  todo = []
+  for src_name in src_names:
+    if force or not is_up_to_date(src_name, store):
+      todo.append(src_name)
+    elif not os.path.exists(
+        os.path.join(store, get_tile_name(src_name)+".html")):
+      # pyramids from before we had viewer pages
+      write_viewer(store, get_tile_name(src_name))
+  print(f"{len(todo)} plates to tile")
+
+  n_done, n_failed, started = 0, 0, time.time()
+  with multiprocessing.Pool(workers) as pool:
+    for src_name, error, seconds in pool.imap_unordered(
+        tile_one, [(src_name, store) for src_name in todo]):
+      if error:
+        n_failed += 1
+        print(f"FAILED {src_name}: {error}")
+      else:
+        n_done += 1
+        print(f"{src_name}: {seconds:.1f} s")
+
+  print(f"{n_done} plates tiled in {time.time()-started:.0f} s,"
+    f" {n_failed} failed")
+  return n_done, n_failed
+
+def parse_command_line():
+  parser = argparse.ArgumentParser(description="Build deep zoom tile"
+    " pyramids of Schmidt plates.")
+  parser.add_argument("dirs", nargs="*", metavar="DIR",
+    help="Directories with plates (*.fit) to tile")
+  parser.add_argument("--from-table", action="store_true",
+    help="Tile all plates in schmidt_telescope_lc.main")
+  parser.add_argument("--store", default=TILE_STORE,
+    help="Directory to write pyramids to (default %(default)s)")
+  parser.add_argument("--workers", type=int, default=None,
+    help="Number of tiling processes (default: one per CPU)")
+  parser.add_argument("--force", action="store_true",
+    help="Rebuild pyramids even if they are up to date")
+  args = parser.parse_args()
+  if not args.dirs and not args.from_table:
+    parser.error("Give directories or --from-table")
+  return args
+
+def main():
+  args = parse_command_line()
+  src_names = list(iter_directory_plates(args.dirs))
+  if args.from_table:
+    src_names.extend(iter_table_plates())
+  n_done, n_failed = make_tiles(src_names, args.store, args.workers,
+    args.force)
+  sys.exit(1 if n_failed else 0)
+
+if __name__=="__main__":
+  main()
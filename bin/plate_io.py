@@ -0,0 +1,149 @@
+"""
+reading plates and replacing files, as needed by annotate_fits.py and
+the batch tools (make_previews.py, make_tiles.py, make_hips.py).
+
+This only needs numpy and astropy.io.fits, so the pool tools can use it
+without loading DaCHS and the rest of the import processor.
+"""
+
+import contextlib
+import os
+import sys
+import tempfile
+
+from astropy.io import fits
+import numpy as np
+
+
+FITS_BLOCK = 2880
+# where annotate_fits.py writes the annotated plates
+ASTROMETRY_OUT_DIR = "/var/gavo/inputs/schmidt_telescope_lc/data_astrometry_test"
+
+def plate_file_name(src_name):
+  """
+  returns the file name we write the annotated plate src_name to.
+
+  >>> plate_file_name("/data/header_done/fai50_1964–07–17.fit")
+  'fai50_1964-07-17.fit'
+  """
+  return os.path.basename(src_name).replace("–","-")
+
+def read_header_bytes(f):
+  """
+  returns the primary header of the FITS file open for binary reading
+  in f, including END and the padding, as bytes.
+
+  f is left positioned at the start of the primary data.
+
+  >>> import io
+  >>> f = io.BytesIO(b"SIMPLE  =                    T".ljust(80)
+  ...   +b"END".ljust(2800)+b"data")
+  >>> len(read_header_bytes(f)), f.read()
+  (2880, b'data')
+  """
+  blocks = []
+  while True:
+    block = f.read(FITS_BLOCK)
+    if len(block)<FITS_BLOCK:
+      raise ValueError("Truncated FITS header or not a FITS file")
+    blocks.append(block)
+    for offset in range(0, FITS_BLOCK, 80):
+      if block[offset:offset+8]==b"END     ":
+        return b"".join(blocks)
+
+@contextlib.contextmanager
+def replacing(path, suffix=".tmp"):
+  """
+  a context manager yielding the name of a new, empty temporary file
+  next to path.
+
+  When the block is left normally, the temporary file (made
+  world-readable) replaces path; when it is left with an exception, it
+  is removed.  So, nobody ever sees a half-written path.  suffix is for
+  writers that go by the file name extension.
+
+  >>> path = os.path.join(tempfile.mkdtemp(), "index.json")
+  >>> with replacing(path) as tmp_name:
+  ...   with open(tmp_name, "w") as f:
+  ...     _ = f.write("new")
+  >>> with replacing(path) as tmp_name:
+  ...   with open(tmp_name, "w") as f:
+  ...     _ = f.write("half")
+  ...   raise ValueError("crash")
+  Traceback (most recent call last):
+  ValueError: crash
+  >>> open(path).read(), os.listdir(os.path.dirname(path))
+  ('new', ['index.json'])
+  """
+  handle, tmp_name = tempfile.mkstemp(dir=os.path.dirname(path) or ".",
+    suffix=suffix)
+  os.close(handle)
+  try:
+    yield tmp_name
+    os.chmod(tmp_name, 0o644)
+    os.replace(tmp_name, path)
+  except:
+    if os.path.exists(tmp_name):
+      os.unlink(tmp_name)
+    raise
+
+@contextlib.contextmanager
+def open_plate(src_name):
+  """
+  a context manager yielding the primary header and the unscaled,
+  memory-mapped primary data of the FITS file src_name, together with
+  a function returning (parts of) that data with BSCALE and BZERO
+  applied, as float32.
+
+  With BSCALE or BZERO, astropy would make a scaled copy of the whole
+  plate when we first touch the data.  As the scaling is linear, we can
+  as well apply it to what is left after reducing or cutting out.
+
+  >>> path = os.path.join(tempfile.mkdtemp(), "plate.fit")
+  >>> fits.PrimaryHDU(np.array([[0, 1], [2, 3]], dtype=np.uint16)
+  ...   ).writeto(path) # stored as int16 with BZERO=32768
+  >>> with open_plate(path) as (header, data, scale):
+  ...   data.dtype.name, header["BZERO"], scale(data[1]).tolist()
+  ('int16', 32768, [2.0, 3.0])
+  """
+  with fits.open(src_name, memmap=True, do_not_scale_image_data=True) as hdus:
+    header = hdus[0].header
+    bscale, bzero = header.get("BSCALE", 1), header.get("BZERO", 0)
+    yield (header, hdus[0].data,
+      lambda arr: np.asarray(arr, dtype=np.float32)*bscale+bzero)
+
+def block_reduce(data, factor, strip_rows=256, pad=False):
+  """
+  returns the 2D array data averaged over factor x factor blocks as
+  float32.
+
+  Rows and columns not making up a full block at the edges are dropped
+  or, with pad, averaged with copies of the last row or column.  data
+  is read strip_rows output rows at a time, so with a memory-mapped
+  data we never have more than a strip of the plate in memory.
+
+  >>> block_reduce(np.arange(35).reshape(5, 7), 2, strip_rows=1).tolist()
+  [[4.0, 6.0, 8.0], [18.0, 20.0, 22.0]]
+  >>> block_reduce(np.array([[0, 2, 10], [2, 4, 20], [6, 6, 30]]), 2,
+  ...   pad=True).tolist()
+  [[2.0, 15.0], [6.0, 30.0]]
+  """
+  if pad:
+    height, width = -(-data.shape[0]//factor), -(-data.shape[1]//factor)
+  else:
+    height, width = data.shape[0]//factor, data.shape[1]//factor
+  reduced = np.empty((height, width), dtype=np.float32)
+  for start in range(0, height, strip_rows):
+    stop = min(start+strip_rows, height)
+    strip = data[start*factor:stop*factor, :width*factor]
+    if pad:
+      strip = np.pad(strip, ((0, (stop-start)*factor-strip.shape[0]),
+        (0, width*factor-strip.shape[1])), mode="edge")
+    reduced[start:stop] = strip.reshape(
+      stop-start, factor, width, factor).mean(axis=(1, 3))
+  return reduced
+
+
+if __name__=="__main__":
+  import doctest
+  sys.exit(doctest.testmod()[0])
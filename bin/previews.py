@@ -0,0 +1,100 @@
+"""
+renders PNG previews of Schmidt plates.
+
+This is what annotate_fits_png.py (with --render-previews) and
+make_previews.py share; it only needs numpy and astropy (and matplotlib
+for writing the PNGs), so the batch tools do not have to load the
+import processor and everything it imports.
+"""
+
+import os
+import sys
+import tempfile
+
+from astropy.io import fits
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from plate_io import block_reduce, open_plate
+
+
+PREVIEW_SIZE = 1024 # longest side of a preview in pixels
+# previews live here rather than next to the plates; see make_previews.py
+PREVIEW_STORE = os.path.normpath(os.path.join(
+  os.path.dirname(os.path.abspath(__file__)), os.pardir, "previews"))
+PREVIEW_MARKER_RADIUS = 12 # pixels in the preview
+
+def get_preview_path(src_name, store=PREVIEW_STORE):
+  """
+  returns the path of the preview of the plate src_name in store.
+
+  >>> get_preview_path("/data/header_done/fai50_1964–07–17.fit", "/previews")
+  '/previews/fai50_1964-07-17.png'
+  """
+  name = os.path.basename(src_name).replace("–","-")
+  return os.path.join(store, os.path.splitext(name)[0]+".png")
+
+def get_preview_pixels(header, reduced_shape, factor, ra_deg, dec_deg):
+  """
+  returns the (x, y) position of ra_deg, dec_deg in a preview made with
+  factor from a plate with header, or None if that position is unknown
+  or not on the preview.
+  """
+  if ra_deg is None or dec_deg is None or "CTYPE1" not in header:
+    return None
+  from astropy.wcs import WCS
+  x, y = WCS(header).all_world2pix([[ra_deg, dec_deg]], 0)[0]
+  # pixel centres of the blocks are at factor*i+(factor-1)/2
+  x, y = (x-(factor-1)/2)/factor, (y-(factor-1)/2)/factor
+  if 0<=x<reduced_shape[1] and 0<=y<reduced_shape[0]:
+    return x, y
+  return None
+
+def render_preview(src_name, dest_name, ra_deg=None, dec_deg=None,
+    max_size=PREVIEW_SIZE):
+  """
+  writes a PNG preview of the plate src_name to dest_name, at most
+  max_size pixels on its longest side.
+
+  The plate is memory-mapped and block-averaged down to the preview
+  size, zscale limits are computed from the (small) reduced image, and
+  the result goes to the PNG directly, without a matplotlib figure.  If
+  ra_deg and dec_deg are given and the plate has a WCS, that position is
+  marked with a red circle.  The first FITS row is at the bottom of the
+  PNG; there is no rotation to the WCS.
+
+  >>> tmpdir = tempfile.mkdtemp()
+  >>> fits.PrimaryHDU(np.random.default_rng(0).normal(1000, 20,
+  ...   (300, 500)).astype(np.int16)).writeto(os.path.join(tmpdir, "p.fit"))
+  >>> render_preview(os.path.join(tmpdir, "p.fit"),
+  ...   os.path.join(tmpdir, "p.png"), max_size=100)
+  >>> import matplotlib.image
+  >>> matplotlib.image.imread(os.path.join(tmpdir, "p.png")).shape[:2]
+  (60, 100)
+  """
+  from astropy.visualization import ZScaleInterval
+  import matplotlib
+  matplotlib.use("Agg")
+  import matplotlib.image
+
+  with open_plate(src_name) as (header, data, scale):
+    factor = max(1, -(-max(data.shape)//max_size))
+    reduced = scale(block_reduce(data, factor))
+
+  vmin, vmax = ZScaleInterval().get_limits(reduced)
+  scaled = np.clip((reduced-vmin)/((vmax-vmin) or 1), 0, 1)
+  gray = (scaled*255).astype(np.uint8)
+  rgb = np.repeat(gray[:, :, np.newaxis], 3, axis=2)
+
+  marker = get_preview_pixels(header, reduced.shape, factor, ra_deg, dec_deg)
+  if marker is not None:
+    y, x = np.ogrid[:reduced.shape[0], :reduced.shape[1]]
+    dist = np.hypot(x-marker[0], y-marker[1])
+    rgb[abs(dist-PREVIEW_MARKER_RADIUS)<1] = [255, 0, 0]
+
+  matplotlib.image.imsave(dest_name, rgb, origin="lower")
+
+
+if __name__=="__main__":
+  import doctest
+  sys.exit(doctest.testmod()[0])